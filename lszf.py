@@ -1,28 +1,91 @@
-import json, os.path, pprint, queue, random, subprocess, sys, threading, time
-import requests
+import contextlib, json, math, os.path, pprint, queue, random, shutil, struct, subprocess, sys, threading, time
+
+requests = None							# Imported in the background by import_requests(), as it's slow
 
 BOOK_FILE = "book.json"
+BENCH_FILE = "bench.json"
 CONFIG_FILE = "config.json"
+ARCHIVE_FILE = "archive.bin"
+ARCHIVE_INDEX_FILE = "archive_index.jsonl"
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
 pp = pprint.PrettyPrinter(indent = 4)
 
-lz = None
-sf = None
+engines = []							# The registry: every engine that takes part in move decisions
+lz = None								# The primary engine (normally Lc0)
+sf = None								# The first checker (normally Stockfish)
+analysis_queue = None
 book = None
+book_index = dict()
+book_stamp = None
 config = None
 headers = None
 
+requests_ready = threading.Event()
+engines_ready = threading.Event()
+startup_clock = time.monotonic()
+
+log_queue = queue.Queue()
+log_context = threading.local()			# .gameId, set by each game's runner thread
+log_threshold = 20
+log_uci = False
+
+LOG_LEVELS = {"debug": 10, "uci": 15, "info": 20, "warning": 30, "error": 40}
+
+archive_MUTEX = threading.Lock()
+
+last_hash_key = None					# (opponent, initialFen, variant) of the last game, for the hash policy
+last_hashfull = 0
+
+prep_cache = dict()						# position hash --> decision, for positions repeat opponents have shown us
+prep_warming = set()					# opponents whose prep is being warmed right now
+prep_MUTEX = threading.Lock()
+
 active_game = None
 active_game_MUTEX = threading.Lock()
+slot_reserved_until = 0					# After accepting, the slot stays taken until gameStart (or this time)
+
+config_stamp = None
+book_MUTEX = threading.Lock()			# Separate, so indexing a big book doesn't hold up load_configs()
+config_MUTEX = threading.Lock()
+
+challenge_queue = None
+challenge_history = dict()				# challenger name --> times of their recent challenges
+waiting_challenges = []					# (time, challenge) for acceptable challenges that came while busy
+waiting_challenges_MUTEX = threading.Lock()
 
 class Engine():
 
-	def __init__(self, command, shortname):
+	def __init__(self, command, shortname, cpus = None):
 
 		self.shortname = shortname
+		self.cpus = cpus
+
+		# Pin the engine before it execs, so every thread it ever starts inherits the mask. We let
+		# taskset do it: preexec_fn could too, but isn't safe while other threads are running...
+
+		pin_later = False
+		if cpus:
+			if shutil.which("taskset"):
+				command = ["taskset", "-c", ",".join(str(cpu) for cpu in cpus)] + (command if isinstance(command, list) else [command])
+			elif hasattr(os, "sched_setaffinity"):
+				pin_later = True
+			else:
+				log("WARNING: can't pin {} to CPUs on this platform".format(shortname), "warning")
+
 		self.process = subprocess.Popen(command, shell = False, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
 		self.output = queue.Queue()
 
+		if pin_later:
+			pin_tasks(self.process.pid, cpus)
+
+		self.spec = dict()				# Its entry in the engine registry, if it has one
+		self.id_name = ""				# As the engine reports it, e.g. "Stockfish 16"
+		self.lease_lock = threading.Lock()
+		self.owner = None
+		self.searching = False		# True from "go" until whoever reads the output sees "bestmove"
+
 		threading.Thread(target = engine_stdout_watcher, args = (self,), daemon = True).start()
 		threading.Thread(target = engine_stderr_watcher, args = (self,), daemon = True).start()
 
@@ -32,10 +95,82 @@ class Engine():
 		b = bytes(msg + "\n", encoding = "ascii")
 		self.process.stdin.write(b)
 		self.process.stdin.flush()
-		# log(self.shortname + " <-- " + msg)
+		if msg == "go" or msg.startswith("go "):
+			self.searching = True
+		if log_uci:
+			log(self.shortname + " <-- " + msg, "uci", self.owner)
+
+	@contextlib.contextmanager
+	def lease(self, owner):
+
+		# Only one owner may talk to the engine at a time. Whatever a previous owner left
+		# behind (a running search, unread output) is dealt with before the new owner gets it.
+
+		if not self.lease_lock.acquire(blocking = False):
+			log("{} is busy with {}, {} waiting".format(self.shortname, self.owner, owner))
+			self.lease_lock.acquire()
+
+		try:
+			self.owner = owner
+			self.sync()
+			yield self
+		finally:
+			try:
+				self.stop()
+			finally:
+				self.owner = None
+				self.lease_lock.release()
+
+	def stop(self):
+
+		# Ends any search in progress, discarding its output up to and including the bestmove.
+
+		if self.searching:
+			self.send("stop")
+			self.drain("bestmove")
+			self.searching = False
+
+	def sync(self):
+
+		# Afterwards, nothing sent before this call can still produce output.
+
+		self.stop()
+		self.send("isready")
+		self.drain("readyok")
+
+	def drain(self, token):
+
+		while 1:
+			try:
+				msg = self.output.get(timeout = 1)
+			except queue.Empty:
+				if self.process.poll() is not None:
+					raise RuntimeError("{} has exited".format(self.shortname))
+				continue
+			if msg.split()[0:1] == [token]:
+				return
 
 # ---------------------------------------------------------------------------------------------------------------------------------
 
+def pin_tasks(pid, cpus):
+
+	# Without taskset: pins every thread the process has so far. It hasn't been sent "uci" yet,
+	# so any threads it starts later will mostly be started by these, and inherit the mask.
+
+	try:
+		tids = [int(tid) for tid in os.listdir("/proc/{}/task".format(pid))]
+	except OSError:
+		tids = [pid]
+
+	for tid in tids:
+		try:
+			os.sched_setaffinity(tid, cpus)
+		except ProcessLookupError:
+			pass			# The thread has exited
+		except OSError as err:
+			log("WARNING: couldn't pin process {}: {}".format(pid, repr(err)), "warning")
+			return
+
 def engine_stdout_watcher(engine):
 
 	while 1:
@@ -43,8 +178,11 @@ def engine_stdout_watcher(engine):
 		if msg == "":
 			return		# EOF
 		msg = msg.strip()
+		if msg.startswith("id name "):
+			engine.id_name = msg[8:]			# Before it's queued, so it's known once uciok is read
 		engine.output.put(msg)
-		# log(engine.shortname + " --> " + msg)
+		if log_uci:
+			log(engine.shortname + " --> " + msg, "uci", engine.owner)
 
 def engine_stderr_watcher(engine):
 
@@ -53,24 +191,130 @@ def engine_stderr_watcher(engine):
 		if msg == "":
 			return		# EOF
 		msg = msg.strip()
-		# log(engine.shortname + " (e) " + msg)
+		if log_uci:
+			log(engine.shortname + " (e) " + msg, "uci", engine.owner)
+
+def log(msg, level = "info", gameId = None):
+
+	# Never blocks: formatting and I/O happen on the logger thread. Lines logged from a game's
+	# thread (or about an engine a game has leased) also go to that game's own file.
+
+	if LOG_LEVELS[level] < log_threshold and not (level == "uci" and log_uci):
+		return
+
+	if gameId is None:
+		gameId = getattr(log_context, "gameId", None)
+
+	log_queue.put((time.time(), level, gameId, msg))
+
+def flush_log():
+	log_queue.join()
+
+def open_game_log(gameId):
+
+	# Only game ids opened here get their own file; other owners' lines (prep, bench...) just
+	# go to the main log.
+
+	log_queue.put((time.time(), "open", gameId, None))
+
+def close_game_log(gameId):
+	log_queue.put((time.time(), "close", gameId, None))
 
-def log(msg):
+def format_log_msg(msg):
 
 	if isinstance(msg, str):
-		if msg.rstrip():
-			print(msg.rstrip())
+		return msg.rstrip() or None
 	elif isinstance(msg, dict):
-		pp.pprint(msg)
+		return pp.pformat(msg)
 	else:
 		try:
-			print(repr(msg))
+			return repr(msg)
 		except:
-			print("log() got unprintable msg")
+			return "log() got unprintable msg"
+
+def logger_thread():
+
+	logfile = None
+	game_ids = set()
+	game_files = dict()
+
+	while 1:
+
+		stamp, level, gameId, msg = log_queue.get()
+
+		try:
+
+			if level == "open":
+				game_ids.add(gameId)
+				continue
+
+			if level == "close":
+				game_ids.discard(gameId)
+				if gameId in game_files:
+					game_files.pop(gameId).close()
+				continue
+
+			text = format_log_msg(msg)
+			if text is None:
+				continue
+
+			if level != "uci":				# Engine traffic only goes to the files
+				print(text)
+
+			prefix = "{} {:<7}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)), level.upper())
+			line = "{} {}\n".format(prefix, text)
+
+			if config["log_file"]:
+				if logfile is None:
+					logfile = open(config["log_file"], "a")
+				if gameId:
+					logfile.write("{} [{}] {}\n".format(prefix, gameId, text))
+				else:
+					logfile.write(line)
+				if logfile.tell() > config["log_max_bytes"]:
+					logfile.close()
+					logfile = None
+					rotate_log(config["log_file"], config["log_backups"])
+
+			if gameId in game_ids and config["game_log_dir"]:
+				if gameId not in game_files:
+					os.makedirs(config["game_log_dir"], exist_ok = True)
+					game_files[gameId] = open(os.path.join(config["game_log_dir"], "{}.txt".format(gameId)), "a")
+				game_files[gameId].write(line)
+
+			if log_queue.empty():
+				for f in [logfile] + list(game_files.values()):
+					if f:
+						f.flush()
+
+		except Exception as err:
+			print("logger_thread() failed: {}".format(repr(err)))
+
+		finally:
+			log_queue.task_done()
+
+def rotate_log(filename, backups):
+
+	# log.txt --> log.txt.1 --> log.txt.2 ... dropping the oldest.
+
+	for n in range(backups - 1, 0, -1):
+		if os.path.exists("{}.{}".format(filename, n)):
+			os.replace("{}.{}".format(filename, n), "{}.{}".format(filename, n + 1))
+
+	if backups > 0:
+		os.replace(filename, "{}.1".format(filename))
+	else:
+		os.remove(filename)
 
 def simple_post(url):
 
-	r = requests.post(url, headers = headers)
+	requests_ready.wait()
+
+	try:
+		r = requests.post(url, headers = headers, timeout = 10)
+	except requests.exceptions.RequestException as err:
+		log("Upon contacting {}: {}".format(url, repr(err)))
+		return False
 
 	if r.status_code != 200:
 		log("Upon contacting {}:".format(url))
@@ -78,6 +322,9 @@ def simple_post(url):
 			log(r.json())
 		except:
 			log("API returned {}".format(r.status_code))
+		return False
+
+	return True
 
 def load_json(filename):
 
@@ -85,40 +332,190 @@ def load_json(filename):
 		ret = json.load(infile)
 		return ret
 
+def file_mtime(filename):
+
+	try:
+		return os.path.getmtime(filename)
+	except OSError:
+		return None
+
 def load_configs():
 
-	global book
+	# Cheap to call often: the files are only re-read when they've changed on disk.
+
 	global config
+	global config_stamp
 	global headers
+	global log_threshold
+	global log_uci
 
-	try:
-		book = load_json(BOOK_FILE)
-	except FileNotFoundError:
-		print("Couldn't load {}".format(BOOK_FILE))
-		book = []
-	except json.decoder.JSONDecodeError:
-		print("{} seems to be illegal JSON".format(BOOK_FILE))
-		book = []
+	with config_MUTEX:
+
+		stamp = file_mtime(CONFIG_FILE)
+
+		if config is not None and stamp == config_stamp:
+			return
+
+		try:
+			new_config = load_json(CONFIG_FILE)
+		except FileNotFoundError:
+			print("Couldn't load {}".format(CONFIG_FILE))
+			sys.exit()
+		except json.decoder.JSONDecodeError:
+			print("{} seems to be illegal JSON".format(CONFIG_FILE))
+			sys.exit()
+
+		new_config.setdefault("whitelist", [])
+		new_config.setdefault("allow_bots", True)
+		new_config.setdefault("open", True)
+
+		new_config.setdefault("challenge_workers", 2)
+		new_config.setdefault("challenge_queue_size", 32)
+		new_config.setdefault("max_waiting_challenges", 2)
+		new_config.setdefault("challenge_wait_secs", 120)
+		new_config.setdefault("rate_limit_challenges", 3)
+		new_config.setdefault("rate_limit_secs", 300)
+
+		new_config.setdefault("stream_timeout_secs", 20)		# Lichess sends a keep-alive newline every few seconds
+		new_config.setdefault("reconnect_min_secs", 1)
+		new_config.setdefault("reconnect_max_secs", 60)
+		new_config.setdefault("game_reconnect_attempts", 10)
+
+		new_config.setdefault("cpu_partition", "none")		# "none", "manual" (each engine's cpus) or "auto"
+		new_config.setdefault("leela_cpu_share", 0.25)
+		new_config.setdefault("derive_threads", True)
+
+		new_config.setdefault("aggregation", "veto")			# "veto", "vote" or "takeover"
+
+		new_config.setdefault("search_mode", "parallel")		# "parallel", "sequential" or "verify"; changing it needs a restart
+		new_config.setdefault("sequential_leela_share", 0.5)
+		new_config.setdefault("moves_to_go", 30)
+
+		new_config.setdefault("search_limit", "clock")		# "clock", or "nodes" for reproducible searches
+		new_config.setdefault("leela_nodes", 800)
+		new_config.setdefault("stockfish_nodes", 1000000)
+
+		new_config.setdefault("analysis_instances", 1)		# Lc0s started by the analyse command
+		new_config.setdefault("analysis_leela_options", {"MinibatchSize": 512})
+		new_config.setdefault("analysis_nodes", 10000)
+
+		new_config.setdefault("resign_cp", 1000)				# Both engines at or below -resign_cp ...
+		new_config.setdefault("resign_moves", 0)				# ... for this many moves in a row (0 = never resign)
+		new_config.setdefault("draw_cp", 15)					# Both engines within draw_cp of 0 ...
+		new_config.setdefault("draw_moves", 0)					# ... for this many moves in a row (0 = never offer)
+		new_config.setdefault("draw_min_ply", 60)
+
+		new_config.setdefault("quick_depth", 0)					# Depth of the shallow pre-search (0 = off)
+		new_config.setdefault("quick_margin_cp", 300)			# How far ahead of the 2nd best move the best must be
+
+		new_config.setdefault("log_level", "info")
+		new_config.setdefault("log_file", "log.txt")			# "" for stdout only
+		new_config.setdefault("log_max_bytes", 10000000)
+		new_config.setdefault("log_backups", 3)
+		new_config.setdefault("game_log_dir", "logs")			# "" for no per-game logs
+		new_config.setdefault("log_uci", False)
+
+		new_config.setdefault("profile_sample_ms", 0)			# Sample the game thread's stack this often (0 = off)
+
+		new_config.setdefault("hash_policy", "clear")			# "clear" every game, keep on "rematch", or "keep" always
+		new_config.setdefault("hash_clear_hashfull", 900)		# ... but clear anyway once Stockfish's hash was this full (permille)
+
+		new_config.setdefault("prep", True)
+		new_config.setdefault("prep_games", 20)					# How many of their recent games to look at
+		new_config.setdefault("prep_plies", 24)					# How deep into those games
+		new_config.setdefault("prep_leela_nodes", 2000)
+		new_config.setdefault("prep_stockfish_nodes", 2000000)
+		new_config.setdefault("prep_cache_size", 10000)
+
+		log_threshold = LOG_LEVELS.get(new_config["log_level"], 20)
+		log_uci = new_config["log_uci"]
+
+		headers = {"Authorization": "Bearer {}".format(new_config["token"])}
+		config = new_config
+		config_stamp = stamp
+
+def load_book():
+
+	# Kept apart from load_configs() because a big book is slow to index, and nothing needs it
+	# until the first move of a game, so it's called from the game's own thread. Like
+	# load_configs(), only re-reads the file when it changes.
+
+	global book
+	global book_index
+	global book_stamp
+
+	with book_MUTEX:
+
+		stamp = file_mtime(BOOK_FILE)
+
+		if book is not None and stamp == book_stamp:
+			return
+
+		try:
+			new_book = load_json(BOOK_FILE)
+		except FileNotFoundError:
+			print("Couldn't load {}".format(BOOK_FILE))
+			new_book = []
+		except json.decoder.JSONDecodeError:
+			print("{} seems to be illegal JSON".format(BOOK_FILE))
+			new_book = []
+
+		book = new_book
+		book_index = make_book_index(new_book)
+		book_stamp = stamp
+
+def import_requests():
+
+	global requests
 
 	try:
-		config = load_json(CONFIG_FILE)
-	except FileNotFoundError:
-		print("Couldn't load {}".format(CONFIG_FILE))
-		sys.exit()
-	except json.decoder.JSONDecodeError:
-		print("{} seems to be illegal JSON".format(CONFIG_FILE))
-		sys.exit()
+		import requests
+	except ImportError:
+		fatal("Couldn't import requests")
+
+	startup_mark("requests imported")
+	requests_ready.set()
+
+def startup_mark(what):
+
+	# One line of the startup timeline, timed from when the script was loaded.
+
+	log("Startup {:>7.2f}s: {}".format(time.monotonic() - startup_clock, what))
+
+def fatal(msg):
 
-	headers = {"Authorization": "Bearer {}".format(config["token"])}
+	# For failures in background threads, where sys.exit() would only end the thread. We'd
+	# rather die and be restarted than sit on the event stream unable to play.
 
-	config.setdefault("whitelist", [])
-	config.setdefault("allow_bots", True)
-	config.setdefault("open", True)
+	log("ERROR: " + msg, "error")
+	flush_log()
+	os._exit(1)
 
 def main():
 
+	threading.Thread(target = import_requests, daemon = True).start()		# Overlaps with everything below
+
 	load_configs()
 
+	threading.Thread(target = logger_thread, daemon = True).start()
+
+	startup_mark("config loaded")
+
+	if len(sys.argv) > 1 and sys.argv[1] == "bench":
+		bench(sys.argv[2:])
+		flush_log()
+		return
+
+	if len(sys.argv) > 1 and sys.argv[1] == "analyse":
+		analyse(sys.argv[2:])
+		flush_log()
+		return
+
+	if len(sys.argv) > 1 and sys.argv[1] == "archive":
+		list_archive(sys.argv[2:])
+		flush_log()
+		return
+
 	threading.Thread(target = app, daemon = True).start()
 
 	while 1:
@@ -130,38 +527,432 @@ def main():
 
 def app():
 
+	# The engines start up in the background while we connect, so challenges can be accepted
+	# straight away. Anything that needs the engines waits on engines_ready.
+
+	global challenge_queue
+
+	threading.Thread(target = warm_up, daemon = True).start()
+
+	challenge_queue = queue.Queue(maxsize = config["challenge_queue_size"])
+
+	for n in range(config["challenge_workers"]):
+		threading.Thread(target = challenge_worker, daemon = True).start()
+
+	connections = [0]
+
+	def connected():
+		connections[0] += 1
+		if connections[0] == 1:				# Only the first is part of startup
+			startup_mark("event stream connected")
+		else:
+			log("Event stream reconnected")
+
+	for j in stream_events("https://lichess.org/api/stream/event", connected = connected):
+		if j["type"] == "challenge":
+			queue_challenge(j["challenge"])
+		if j["type"] == "challengeCanceled":
+			forget_waiting_challenge(j["challenge"]["id"])
+		if j["type"] == "gameStart":
+			start_game(j["game"]["id"])
+
+	log("ERROR: Main event stream closed!", "error")
+
+def warm_up():
+
+	try:
+		start_engines()
+	except Exception as err:
+		fatal("couldn't start engines: {}".format(repr(err)))
+
+	load_book()
+	startup_mark("book loaded")
+
+def engine_specs():
+
+	# The configured engines, or the classic pair built from the leela_* / stockfish_* settings.
+	# A spec has a name, command, options and nodes (for node-limited searches), and optionally
+	# role ("primary" or "checker"), weight (for voting), prep_nodes (default: nodes) and cpus
+	# (for manual pinning). Node counts mean very different things to different engines, so
+	# there's no sensible default for them.
+
+	if config.get("engines"):
+		specs = []
+		for spec in config["engines"]:
+			if "nodes" not in spec:
+				fatal("engine {} has no \"nodes\" setting".format(spec.get("name")))
+			specs.append(dict(spec, prep_nodes = spec.get("prep_nodes", spec["nodes"])))
+		return specs
+
+	return [
+		{"name": "LZ", "command": config["leela_command"], "options": config["leela_options"], "role": "primary",
+			"nodes": config["leela_nodes"], "prep_nodes": config["prep_leela_nodes"], "cpus": config.get("leela_cpus")},
+		{"name": "SF", "command": config["stockfish_command"], "options": config["stockfish_options"], "role": "checker",
+			"nodes": config["stockfish_nodes"], "prep_nodes": config["prep_stockfish_nodes"], "cpus": config.get("stockfish_cpus")},
+	]
+
+def primary_index(specs):
+
+	for i, spec in enumerate(specs):
+		if spec.get("role") == "primary":
+			return i
+	return 0
+
+def start_engines():
+
+	# Every engine is spawned and brought up (uci, options, network load) in its own thread, so the
+	# slowest of them sets the startup time rather than the sum. Sets engines_ready when all are done.
+
+	global engines
 	global lz
 	global sf
 
-	lz = Engine(config["leela_command"], "LZ")
-	sf = Engine(config["stockfish_command"], "SF")
+	specs = engine_specs()
 
-	lz.send("uci")
-	sf.send("uci")
+	if len(specs) < 2:
+		fatal("at least two engines are needed")
 
-	for key in config["leela_options"]:
-		lz.send("setoption name {} value {}".format(key, config["leela_options"][key]))
+	if config["search_mode"] == "verify" and (len(specs) != 2 or config["aggregation"] != "veto"):
+		fatal("verify mode needs exactly two engines and aggregation \"veto\"")
 
-	lz.send("ucinewgame")	# Causes Leela to actually load its network.
+	if config["search_mode"] == "parallel":
+		cpu_lists = partition_cpus(specs)
+		thread_counts = [len(cpus) if cpus else None for cpus in cpu_lists]
+	else:
+		# The engines take turns, so each should have the whole machine while it searches.
+		if config["cpu_partition"] != "none":
+			log("WARNING: cpu_partition is ignored in {} mode".format(config["search_mode"]), "warning")
+		cpu_lists = [None] * len(specs)
+		thread_counts = [len(available_cpus())] * len(specs)
 
-	for key in config["stockfish_options"]:
-		sf.send("setoption name {} value {}".format(key, config["stockfish_options"][key]))
+	started = [None] * len(specs)
+	errors = []
 
-	event_stream = requests.get("https://lichess.org/api/stream/event", headers = headers, stream = True)
+	def start(i):
+		try:
+			started[i] = start_engine(specs[i], cpu_lists[i], thread_counts[i])
+		except Exception as err:
+			errors.append("{}: {}".format(specs[i]["name"], repr(err)))
 
-	for line in event_stream.iter_lines():
-		if line:
-			dec = line.decode("utf-8")
-			j = json.loads(dec)
-			if j["type"] == "challenge":
-				handle_challenge(j["challenge"])
-			if j["type"] == "gameStart":
-				start_game(j["game"]["id"])
+	workers = [threading.Thread(target = start, args = (i, ), daemon = True) for i in range(len(specs))]
 
-def handle_challenge(challenge):
+	for t in workers:
+		t.start()
+	for t in workers:
+		t.join()
 
-	global active_game
-	global active_game_MUTEX
+	if errors:
+		raise RuntimeError("; ".join(errors))
+
+	engines = started
+	lz = engines[primary_index(specs)]
+	sf = [engine for engine in engines if engine is not lz][0]
+
+	if config["quick_depth"] > 0 and "stockfish" not in sf.id_name.lower():
+		fatal("quick_depth needs Stockfish as the first checker, not {}".format(sf.id_name or sf.shortname))
+
+	startup_mark("engines ready")
+	engines_ready.set()
+
+def start_engine(spec, cpus, thread_count = None):
+
+	engine = Engine(spec["command"], spec["name"], cpus)
+	engine.spec = spec
+	startup_mark("{} spawned".format(spec["name"]))
+
+	if cpus:
+		log("CPUs for {}: {}".format(spec["name"], cpus))
+
+	options = dict(spec.get("options", {}))
+
+	if config["derive_threads"] and thread_count:
+		options["Threads"] = thread_count
+
+	engine.send("uci")
+	engine.drain("uciok")
+	startup_mark("{} uciok".format(spec["name"]))
+
+	for key in options:
+		engine.send("setoption name {} value {}".format(key, options[key]))
+
+	engine.send("ucinewgame")	# Causes Leela to actually load its network.
+	engine.send("isready")
+	engine.drain("readyok")		# ...which it has finished doing once it answers this.
+	startup_mark("{} readyok, network loaded".format(spec["name"]))
+
+	return engine
+
+@contextlib.contextmanager
+def leases(engine_list, owner):
+
+	# Leases are always taken in registry order, so two owners can't deadlock.
+
+	with contextlib.ExitStack() as stack:
+		for engine in sorted(engine_list, key = engines.index):
+			stack.enter_context(engine.lease(owner))
+		yield
+
+def stream_events(url, finished = None, max_attempts = 0, timings = None, connected = None, stage = None):
+
+	# Yields the JSON objects from a Lichess stream, reconnecting with exponential backoff and
+	# jitter if it drops or goes quiet for longer than stream_timeout_secs. When the server closes
+	# the stream, we stop if finished() says so, otherwise reconnect. max_attempts = 0 means forever.
+	# connected() if given is called each time the server accepts the connection. With timings, the
+	# time spent waiting for each line (not decoding it, nor in the caller) goes to the stage named
+	# by stage(), or "stream".
+
+	requests_ready.wait()
+
+	backoff = config["reconnect_min_secs"]
+	attempts = 0
+
+	while 1:
+
+		try:
+			r = requests.get(url, headers = headers, stream = True, timeout = (10, config["stream_timeout_secs"]))
+
+			if r.status_code != 200:
+				log("Stream {} returned {}".format(url, r.status_code))
+			else:
+				if connected is not None:
+					connected()
+				waiting_since = time.perf_counter()
+				for line in r.iter_lines():
+					attempts = 0
+					backoff = config["reconnect_min_secs"]
+					if not line:					# Filter out keep-alive newlines
+						continue
+					if timings is not None:
+						timings.add(stage() if stage else "stream", time.perf_counter() - waiting_since)
+					try:
+						with timed(timings, "decode"):
+							j = json.loads(line.decode("utf-8"))
+					except ValueError:
+						log("Stream {} sent junk: {}".format(url, line))
+						continue
+					yield j
+					waiting_since = time.perf_counter()
+				log("Stream {} closed".format(url))
+
+		except requests.exceptions.RequestException as err:
+			log("Stream {} failed: {}".format(url, repr(err)))
+
+		if finished is not None and finished():
+			return
+
+		attempts += 1
+		if max_attempts > 0 and attempts > max_attempts:
+			log("Giving up on stream {}".format(url))
+			return
+
+		delay = backoff * random.uniform(0.5, 1.0)
+		log("Reconnecting to {} in {:.1f}s".format(url, delay))
+		time.sleep(delay)
+		backoff = min(backoff * 2, config["reconnect_max_secs"])
+
+def parse_cpulist(s):
+
+	# Linux cpulist format, e.g. "0-3,8-11"
+
+	ret = []
+	for part in s.strip().split(","):
+		if "-" in part:
+			lo, hi = part.split("-")
+			ret += list(range(int(lo), int(hi) + 1))
+		elif part:
+			ret.append(int(part))
+	return ret
+
+def read_cpulist(path):
+
+	try:
+		with open(path) as infile:
+			return parse_cpulist(infile.read())
+	except (OSError, ValueError):
+		return None
+
+def available_cpus():
+
+	if hasattr(os, "sched_getaffinity"):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(os.cpu_count() or 1))
+
+def numa_nodes(cpus):
+
+	# The given CPUs grouped by NUMA node (from sysfs), or one group if that's unknown.
+
+	nodes = []
+
+	try:
+		names = sorted(name for name in os.listdir("/sys/devices/system/node") if name.startswith("node") and name[4:].isdigit())
+	except OSError:
+		names = []
+
+	for name in names:
+		node = read_cpulist("/sys/devices/system/node/{}/cpulist".format(name)) or []
+		node = [cpu for cpu in node if cpu in cpus]
+		if node:
+			nodes.append(node)
+
+	if len(nodes) == 0:
+		nodes = [cpus]
+
+	return nodes
+
+def physical_cores(cpus):
+
+	# The given CPUs grouped into SMT siblings, so two engines never share a physical core.
+
+	cores = []
+	seen = set()
+
+	for cpu in cpus:
+		if cpu in seen:
+			continue
+		siblings = read_cpulist("/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list".format(cpu)) or [cpu]
+		core = [c for c in siblings if c in cpus and c not in seen] or [cpu]
+		seen.update(core)
+		cores.append(core)
+
+	return cores
+
+def partition_cpus(specs):
+
+	# Returns a list of CPUs for each engine spec; None means don't pin that engine.
+	# In auto mode the primary gets leela_cpu_share and the others split the rest.
+
+	mode = config["cpu_partition"]
+
+	if mode == "manual":
+		return [spec.get("cpus") for spec in specs]
+
+	if mode != "auto":
+		return [None] * len(specs)
+
+	cpus = available_cpus()
+	nodes = numa_nodes(cpus)
+
+	if len(nodes) >= len(specs):
+		units = nodes				# Whole NUMA nodes per engine, keeping memory traffic local
+	else:
+		units = physical_cores(cpus)
+
+	if len(units) < len(specs):
+		log("WARNING: too few cores to partition", "warning")
+		return [None] * len(specs)
+
+	others = len(specs) - 1
+	n = min(max(1, round(len(units) * config["leela_cpu_share"])), len(units) - others)
+
+	primary = primary_index(specs)
+	rest = units[n:]
+	ret = []
+
+	for i in range(len(specs)):
+		if i == primary:
+			ret.append(sorted(sum(units[:n], [])))
+		else:
+			k = len(ret) - (1 if len(ret) > primary else 0)			# Index among the others
+			lo = k * len(rest) // others
+			hi = (k + 1) * len(rest) // others
+			ret.append(sorted(sum(rest[lo:hi], [])))
+
+	return ret
+
+def queue_challenge(challenge):
+
+	# Called on the event stream thread, so it must never block.
+
+	try:
+		challenge_queue.put_nowait(challenge)
+	except queue.Full:
+		log("Challenge queue is full!")
+		threading.Thread(target = decline, args = (challenge["id"], ), daemon = True).start()
+
+def challenge_worker():
+
+	while 1:
+		challenge = challenge_queue.get()
+		handle_challenge(challenge)
+
+def rate_limited(name):
+
+	# Records the challenge and returns True if this challenger has sent too many recently.
+	# Challengers with nothing recent are forgotten, so the history doesn't grow forever.
+
+	now = time.monotonic()
+
+	with waiting_challenges_MUTEX:
+		for other in list(challenge_history):
+			recent = [t for t in challenge_history[other] if now - t < config["rate_limit_secs"]]
+			if recent:
+				challenge_history[other] = recent
+			else:
+				del challenge_history[other]
+		recent = challenge_history.setdefault(name, [])
+		recent.append(now)
+		return len(recent) > config["rate_limit_challenges"]
+
+def claim_slot():
+
+	# Reserves the game slot for a challenge we're about to accept. Returns False if we're busy.
+
+	global slot_reserved_until
+
+	with active_game_MUTEX:
+		if active_game or time.monotonic() < slot_reserved_until:
+			return False
+		slot_reserved_until = time.monotonic() + 30
+		return True
+
+def release_slot():
+
+	global slot_reserved_until
+
+	with active_game_MUTEX:
+		slot_reserved_until = 0
+
+def hold_challenge(challenge):
+
+	# Keeps an acceptable challenge until the current game ends. Returns False if there's no room.
+
+	with waiting_challenges_MUTEX:
+		if len(waiting_challenges) >= config["max_waiting_challenges"]:
+			return False
+		waiting_challenges.append((time.monotonic(), challenge))
+		return True
+
+def forget_waiting_challenge(challengeId):
+
+	with waiting_challenges_MUTEX:
+		waiting_challenges[:] = [item for item in waiting_challenges if item[1]["id"] != challengeId]
+
+def accept_waiting_challenge():
+
+	# Called when a game ends: accept the oldest held challenge that's still fresh.
+
+	while 1:
+
+		with waiting_challenges_MUTEX:
+			if len(waiting_challenges) == 0:
+				return
+			received, challenge = waiting_challenges.pop(0)
+
+		if time.monotonic() - received > config["challenge_wait_secs"]:
+			decline(challenge["id"])
+			continue
+
+		if not claim_slot():
+			if not hold_challenge(challenge):
+				decline(challenge["id"])
+			return
+
+		if accept(challenge["id"]):
+			return
+
+		release_slot()
+
+def handle_challenge(challenge):
 
 	try:
 
@@ -171,12 +962,11 @@ def handle_challenge(challenge):
 
 		accepting = True
 
-		# Already playing...
+		# Too many challenges from this person...
 
-		with active_game_MUTEX:
-			if active_game:
-				log("But I'm in a game!")
-				accepting = False
+		if rate_limited(challenge["challenger"]["name"]):
+			log("But they're challenging too often!")
+			accepting = False
 
 		# Not open...
 
@@ -214,8 +1004,20 @@ def handle_challenge(challenge):
 			log("But I don't like the time control! ({}+{})".format(challenge["timeControl"]["limit"], challenge["timeControl"]["increment"]))
 			accepting = False
 
+		# Already playing (or about to)...
+
+		if accepting and not claim_slot():
+			if hold_challenge(challenge):
+				log("But I'm in a game! Holding it until I'm free.")
+				start_prep(challenge["challenger"]["name"])
+				return
+			log("But I'm in a game!")
+			accepting = False
+
 		if accepting:
-			accept(challenge["id"])
+			start_prep(challenge["challenger"]["name"])
+			if not accept(challenge["id"]):
+				release_slot()
 		else:
 			decline(challenge["id"])
 
@@ -226,12 +1028,12 @@ def handle_challenge(challenge):
 def decline(challengeId):
 
 	log("Declining challenge {}".format(challengeId))
-	simple_post("https://lichess.org/api/challenge/{}/decline".format(challengeId))
+	return simple_post("https://lichess.org/api/challenge/{}/decline".format(challengeId))
 
 def accept(challengeId):
 
 	log("Accepting challenge {}".format(challengeId))
-	simple_post("https://lichess.org/api/challenge/{}/accept".format(challengeId))
+	return simple_post("https://lichess.org/api/challenge/{}/accept".format(challengeId))
 
 def abort_game(gameId):
 
@@ -245,21 +1047,31 @@ def abort_game(gameId):
 		if active_game == gameId:
 			active_game = None
 
+def resign_game(gameId):
+
+	log("Resigning game {}".format(gameId))
+	simple_post("https://lichess.org/api/bot/game/{}/resign".format(gameId))
+
 def start_game(gameId):
 
 	global active_game
 	global active_game_MUTEX
+	global slot_reserved_until
 
 	autoabort = False
 
 	with active_game_MUTEX:
+		if active_game == gameId:
+			log("Ignoring repeated start of game {}".format(gameId))
+			return
 		if active_game:
 			autoabort = True
 		else:
 			active_game = gameId
+			slot_reserved_until = 0
 
 	if autoabort:	# Don't do this inside the above "with", as abort() also uses the mutex.
-		log("WARNING: game starting but I seem to be in a game")
+		log("WARNING: game starting but I seem to be in a game", "warning")
 		abort_game(gameId)
 		return
 
@@ -267,200 +1079,702 @@ def start_game(gameId):
 
 	log("Game {} starting.".format(gameId))
 
-	threading.Thread(target = runner, args = (gameId, ), daemon = True).start()
+	threading.Thread(target = runner, args = (gameId, ), name = gameId, daemon = True).start()
 
 # ---------------------------------------------------------------------------------------------------------
 
-def runner(gameId):
+class Game():
 
-	# So this will be its own thread, and handles the core game logic.
+	def __init__(self, gameId):
 
-	global active_game
-	global active_game_MUTEX
+		self.gameId = gameId
+		self.gameFull = None
+		self.colour = None
+		self.board = None
+		self.moves_string = ""			# The server's move list as of the last state we applied
+		self.takeback_offered = False
+		self.last_search = None			# (ply, hash) of the last position we searched
+		self.over = False
+		self.losing_moves = 0			# Consecutive moves both engines thought lost
+		self.drawn_moves = 0			# Consecutive moves both engines thought dead drawn
+		self.timings = Timings()
+		self.clocks = []				# Mover's clock (ms) after each ply, or None if we never saw it
+		self.decisions = []				# (ply, decision) for each of our moves
+		self.status = None
+		self.winner = None
+		self.hash_key = None
+		self.lz_reuse = []				# (nodes reused from the previous search, total nodes) per Lc0 search
+		self.sf_hashfull = 0			# Highest hashfull Stockfish reported
 
-	lz.send("ucinewgame")
-	sf.send("ucinewgame")
+	def update(self, state):
 
-	events = requests.get("https://lichess.org/api/bot/game/stream/{}".format(gameId), headers = headers, stream = True)
+		# Applies only the difference between the server's move list and ours.
+		# Returns False if the state looks like an out-of-order copy of an earlier one.
 
-	gameFull = None
-	colour = None
+		taken_back, added = diff_moves(self.moves_string, state["moves"])
 
-	for line in events.iter_lines():
+		if taken_back > 0 and not added and not self.takeback_offered:
+			return False
 
-		if not line:					# Filter out keep-alive newlines
-			continue
+		for n in range(taken_back):
+			self.board.undo()
+			self.clocks.pop()
 
-		# Each line is a JSON object containing a type field. Possible values are:
-		#		gameFull	-- Full game data. All values are immutable, except for the state field.
-		#		gameState	-- Current state of the game. Immutable values not included.
-		#		chatLine 	-- Chat message sent by a user (or the bot itself) in the room "player" or "spectator".
+		for mv in added:
+			self.board.move(mv)
+			self.clocks.append(None)
 
-		dec = line.decode("utf-8")
-		j = json.loads(dec)
+		if added and "wtime" in state:		# The clock of whoever moved last
+			self.clocks[-1] = state["btime"] if self.board.active == "w" else state["wtime"]
 
-		if j["type"] == "gameFull":		# This should be the first thing we get.
+		if taken_back > 0:
+			self.last_search = None
 
-			gameFull = j
+		self.moves_string = state["moves"]
+		self.takeback_offered = state.get("wtakeback", False) or state.get("btakeback", False)
+		return True
 
-			if j["variant"]["key"] == "chess960":
-				log("setoption name UCI_Chess960 value true")
-				lz.send("setoption name UCI_Chess960 value true")
-				sf.send("setoption name UCI_Chess960 value true")
-			else:
-				log("setoption name UCI_Chess960 value false")
-				lz.send("setoption name UCI_Chess960 value false")
-				sf.send("setoption name UCI_Chess960 value false")
+def diff_moves(old_string, new_string):
 
-			if j["white"]["name"].lower() == config["account"].lower():
-				colour = "white"
+	# Returns (number of moves taken back, list of moves added) going from old to new.
+	# The usual case -- new extends old -- is decided without splitting the whole string.
 
-			if j["black"]["name"].lower() == config["account"].lower():
-				colour = "black"
+	if new_string == old_string:
+		return 0, []
 
-			handle_state(j["state"], gameId, gameFull, colour)
+	if old_string == "":
+		return 0, new_string.split()
 
-		elif j["type"] == "gameState":
+	if new_string.startswith(old_string + " "):
+		return 0, new_string[len(old_string) + 1:].split()
 
-			handle_state(j, gameId, gameFull, colour)
+	old = old_string.split()
+	new = new_string.split()
 
-	log("Game stream closed...")
+	common = 0
+	while common < len(old) and common < len(new) and old[common] == new[common]:
+		common += 1
 
-	with active_game_MUTEX:
-		active_game = None
+	return len(old) - common, new[common:]
 
-def handle_state(state, gameId, gameFull, colour):
+def runner(gameId):
 
-	if state["status"] != "started":
-		return
+	# So this will be its own thread, and handles the core game logic.
 
-	if gameFull is None or colour is None:
-		log("ERROR: handle_state() called without full info available")
-		abort(gameId)
-		return
+	global active_game
+	global active_game_MUTEX
 
-	moves = []
+	log_context.gameId = gameId
+	open_game_log(gameId)
 
-	if state["moves"]:
-		moves = state["moves"].split()
+	if not engines_ready.is_set():
+		log("Waiting for engines to finish starting")
+		engines_ready.wait()
 
-	if len(moves) % 2 == 0 and colour == "black":
-		return
-	if len(moves) % 2 == 1 and colour == "white":
-		return
+	load_book()			# Here rather than in start_game(), as re-indexing a changed book is slow
 
-	if len(moves) > 0:
-		log("           {}".format(moves[-1]))
+	game = Game(gameId)
 
-	# Crude latency compensation...
+	sampler = None
+	if config["profile_sample_ms"] > 0:
+		sampler = Sampler(threading.get_ident(), config["profile_sample_ms"] / 1000)
 
-	state["wtime"] = max(state["wtime"] - 10000, 500)
-	state["btime"] = max(state["btime"] - 10000, 500)
+	# If the stream drops mid-game we reconnect; the server then starts again with gameFull,
+	# and the usual state diffing picks up from wherever we were.
 
-	mymove = genmove(gameFull["initialFen"], state["moves"], state["wtime"], state["btime"], state["winc"], state["binc"])
+	events = stream_events("https://lichess.org/api/bot/game/stream/{}".format(gameId),
+		finished = lambda: game.over, max_attempts = config["game_reconnect_attempts"], timings = game.timings,
+		stage = lambda: "opponent" if opponent_to_move(game) else "stream")
 
-	simple_post("https://lichess.org/api/bot/game/{}/move/{}".format(gameId, mymove))
+	# Whatever goes wrong in here, the cleanup at the end must run, or we'd never take another game.
 
-def genmove(initial_fen, moves_string, wtime, btime, winc, binc):
+	try:
 
-	if initial_fen == "startpos":
-		mv = book_move(moves_string)
-		if mv:
-			return mv
+		for j in events:
+
+			# Each line is a JSON object containing a type field. Possible values are:
+			#		gameFull	-- Full game data. All values are immutable, except for the state field.
+			#		gameState	-- Current state of the game. Immutable values not included.
+			#		chatLine 	-- Chat message sent by a user (or the bot itself) in the room "player" or "spectator".
+
+			if j["type"] == "gameFull":		# This should be the first thing we get.
+
+				game.gameFull = j
+
+				if game.board is None:
+					with leases(engines, gameId):
+						new_game_hash(game, j)
+
+				if j["white"]["name"].lower() == config["account"].lower():
+					game.colour = "white"
+
+				if j["black"]["name"].lower() == config["account"].lower():
+					game.colour = "black"
+
+				if game.board is None:
+					game.board = Board(j["initialFen"], chess960 = j["variant"]["key"] == "chess960")
+
+				handle_state(j["state"], game)
+
+			elif j["type"] == "gameState":
+
+				handle_state(j, game)
+
+		log("Game stream closed...")
+
+	except Exception as err:
+		log("ERROR: game thread failed: {}".format(repr(err)), "error")
+
+	finally:
+
+		try:
+			log(game.timings.summary())
+			if sampler:
+				log(sampler.stop())
+
+			log(hash_summary(game))
+			end_game_hash(game)
+
+			if game.gameFull is not None:
+				archive_game(game)
+		except Exception as err:
+			log("ERROR: couldn't wrap up game: {}".format(repr(err)), "error")
+
+		close_game_log(gameId)
+
+		with active_game_MUTEX:
+			active_game = None
+
+		accept_waiting_challenge()
+
+def opponent_to_move(game):
+	return game.board is not None and not game.over and (game.board.active == "w") != (game.colour == "white")
+
+def handle_state(state, game):
+
+	if state["status"] not in ["created", "started"]:
+		game.over = True
+		game.status = state["status"]
+		game.winner = state.get("winner")
+
+	if state["status"] == "created":
+		return
+
+	if game.gameFull is None or game.colour is None or game.board is None:
+		log("ERROR: handle_state() called without full info available", "error")
+		if not game.over:
+			abort_game(game.gameId)
+		return
+
+	board = game.board
+
+	# Even a final state goes through update(), as it may carry the game's last move.
+
+	try:
+		with timed(game.timings, "update"):
+			ok = game.update(state)
+		if not ok:
+			log("Ignoring out-of-order state")
+			return
+	except Exception as err:
+		log("ERROR: couldn't follow the game: {}".format(repr(err)), "error")
+		if not game.over:
+			abort_game(game.gameId)
+		return
+
+	if state["status"] != "started":
+		return
+
+	# The board knows the real side to move, even for FEN starts with black to move...
+
+	if board.active == "w" and game.colour == "black":
+		return
+	if board.active == "b" and game.colour == "white":
+		return
+
+	# Never search the same position twice, e.g. when a draw offer resends the state we've answered.
+	# Only positions whose move reached the server count, so a failed post is retried on reconnect.
+
+	key = (len(board.moves), board.hash())
+	if key == game.last_search:
+		return
+
+	started = time.perf_counter()
+
+	if len(board.moves) > 0:
+		log("           {}".format(board.moves[-1]))
+
+	# Crude latency compensation...
+
+	state["wtime"] = max(state["wtime"] - 10000, 500)
+	state["btime"] = max(state["btime"] - 10000, 500)
+
+	decision = genmove(board, game.gameFull["initialFen"], game.moves_string, state["wtime"], state["btime"], state["winc"], state["binc"], game.timings)
+
+	if decision["move"] is None:
+		log("ERROR: no legal move found, not moving", "error")
+		return
+
+	update_consensus(game, decision)
+	update_hash_stats(game, decision)
+	game.decisions.append((len(board.moves), decision))
+
+	if config["resign_moves"] > 0 and game.losing_moves >= config["resign_moves"]:
+		resign_game(game.gameId)
+		return
+
+	url = "https://lichess.org/api/bot/game/{}/move/{}".format(game.gameId, decision["move"])
+
+	if wants_draw(game, state):
+		log("Offering draw")
+		game.drawn_moves = 0			# So we don't offer again on every move
+		url += "?offeringDraw=true"
+
+	with timed(game.timings, "post"):
+		if simple_post(url):
+			game.last_search = key
+
+	game.timings.add("move", time.perf_counter() - started)
+
+def new_game_hash(game, gameFull):
+
+	# Decides whether this game starts with cleared engine hash / tree, per hash_policy.
+	# Keeping them pays off when we're likely to see the same positions again, e.g. a rematch.
+	# The caller must hold the leases of all engines.
+
+	global last_hash_key
+
+	opponent = player_name(gameFull["black" if gameFull["white"].get("name", "").lower() == config["account"].lower() else "white"])
+	game.hash_key = (opponent.lower(), gameFull["initialFen"], gameFull["variant"]["key"])
+
+	policy = config["hash_policy"]
+	clear = True
+
+	if last_hash_key is not None and last_hash_key[2] == game.hash_key[2] and last_hashfull < config["hash_clear_hashfull"]:
+		if policy == "keep":
+			clear = False
+		elif policy == "rematch" and last_hash_key == game.hash_key:
+			clear = False
+
+	if clear:
+		for engine in engines:
+			engine.send("ucinewgame")
+	else:
+		log("Keeping engine hash from the last game (hashfull was {})".format(last_hashfull))
+
+	last_hash_key = None			# Until this game ends, there's no "last game" to match
+
+def end_game_hash(game):
+
+	global last_hash_key
+	global last_hashfull
+
+	last_hash_key = game.hash_key
+	last_hashfull = game.sf_hashfull
+
+def update_hash_stats(game, decision):
+
+	if decision["sf"] and decision["sf"].get("hashfull") is not None:
+		game.sf_hashfull = max(game.sf_hashfull, decision["sf"]["hashfull"])
+
+	if decision["lz"]:
+		reused = tree_reuse(decision["lz"])
+		if reused is not None:
+			game.lz_reuse.append((reused, decision["lz"]["nodes"]))
+
+def tree_reuse(result):
+
+	# Lc0 reports nodes including the visits it inherited from the previous search, but computes
+	# nps from the new playouts only, so the difference is the part of the tree it reused.
+
+	if result.get("nodes") is None or result.get("nps") is None or result.get("time") is None:
+		return None
+	return max(0, result["nodes"] - result["nps"] * result["time"] // 1000)
+
+def hash_summary(game):
+
+	reused = sum(item[0] for item in game.lz_reuse)
+	total = sum(item[1] for item in game.lz_reuse)
+
+	return "Lc0 tree reuse: {:.1%} of nodes over {} searches ; Stockfish hashfull max: {}".format(
+		reused / total if total else 0, len(game.lz_reuse), game.sf_hashfull)
+
+def update_consensus(game, decision):
+
+	# Counts the consecutive moves on which both engines agreed the game is lost, or dead drawn.
+	# Moves with no search behind them (book etc.) leave the counts alone.
+
+	if not decision["lz"] or not decision["sf"]:
+		return
+
+	lz_score = decision["lz"]["score"]
+	sf_score = decision["sf"]["score"]
+
+	if lz_score is None or sf_score is None:
+		return
+
+	if lz_score <= -config["resign_cp"] and sf_score <= -config["resign_cp"]:
+		game.losing_moves += 1
+	else:
+		game.losing_moves = 0
+
+	if abs(lz_score) <= config["draw_cp"] and abs(sf_score) <= config["draw_cp"]:
+		game.drawn_moves += 1
+	else:
+		game.drawn_moves = 0
+
+def wants_draw(game, state):
+
+	if config["draw_moves"] <= 0 or len(game.board.moves) < config["draw_min_ply"]:
+		return False
+
+	# If they've offered, one drawn verdict is enough; offering back accepts.
+
+	if state.get("bdraw" if game.colour == "white" else "wdraw"):
+		return game.drawn_moves >= 1
+
+	return game.drawn_moves >= config["draw_moves"]
+
+def genmove(board, initial_fen, moves_string, wtime, btime, winc, binc, timings = None):
+
+	# Returns a decision: the move to play and where it came from -- "book", "prep", "forced", "quick",
+	# "agreed", "vote", "lc0" (the primary's move) or "sf" (a checker's move) -- plus the search results
+	# of the primary ("lz"), the first checker ("sf") and every engine by name ("results").
+
+	# The book and the prep cache come from standard chess, whose castling moves mean something
+	# else in Chess960. Any shortcut move that isn't legal is dropped in favour of a search.
+
+	if not board.chess960:
+
+		with timed(timings, "book"):
+			mv = book_move(board)
+		if mv and board.is_legal(mv):
+			return {"move": mv, "source": "book", "lz": None, "sf": None}
+		if mv:
+			log("WARNING: rejecting illegal book move {}".format(mv), "warning")
+
+		with timed(timings, "prep"):
+			cached = prep_cache.get(board.hash())
+		if cached and board.is_legal(cached["move"]):
+			log("     Prep: {}".format(cached["move"]))
+			return dict(cached, source = "prep")
+
+	with timed(timings, "movegen"):
+		legal_moves = board.legal_moves()
+	if len(legal_moves) == 1:
+		log("   Forced: {}".format(legal_moves[0]))
+		return {"move": legal_moves[0], "source": "forced", "lz": None, "sf": None}
 
 	if initial_fen == "startpos":
 		pos_string = "startpos"
 	else:
 		pos_string = "fen " + initial_fen
 
-	lz.send("position {} moves {}".format(pos_string, moves_string))
-	lz.send("go wtime {} btime {} winc {} binc {}".format(wtime, btime, winc, binc))
-	sf.send("position {} moves {}".format(pos_string, moves_string))
-	sf.send("go wtime {} btime {} winc {} binc {}".format(wtime, btime, winc, binc))
+	owner = threading.current_thread().name
+	mode = config["search_mode"]
 
-	lz_score = None
-	lz_move = None
-	sf_score = None
-	sf_move = None
+	with timed(timings, "engines"), leases(engines, owner):
 
-	while lz_move is None or sf_move is None:
+		# Set on every search, since prep or a bench run may have used the engines in between.
 
-		# Read all available LZ info...
+		for engine in engines:
+			engine.send("setoption name UCI_Chess960 value {}".format("true" if board.chess960 else "false"))
 
-		try:
-			while 1:
-				msg = lz.output.get(block = False)
-				tokens = msg.split()
-
-				if "score cp" in msg and "lowerbound" not in msg and "upperbound" not in msg:
-					score_index = tokens.index("cp") + 1
-					lz_score = int(tokens[score_index])
-				elif "score mate" in msg:
-					mate_index = tokens.index("mate") + 1
-					mate_in = int(tokens[mate_index])
-					if mate_in > 0:
-						lz_score = 1000000 - (mate_in * 1000)
-					else:
-						lz_score = -1000000 + (-mate_in * 1000)
-				elif "bestmove" in msg:
-					lz_move = tokens[1]
-					break
+		if config["quick_depth"] > 0:
+			mv = quick_move(pos_string, moves_string)
+			if mv and board.is_legal(mv):
+				log("    Quick: {}".format(mv))
+				return {"move": mv, "source": "quick", "lz": None, "sf": None}
+			if mv:
+				log("WARNING: rejecting illegal quick move {}".format(mv), "warning")
 
-		except queue.Empty:
-			pass
+		if mode == "parallel":
 
-		# Read all available SF info...
+			go = "go wtime {} btime {} winc {} binc {}".format(wtime, btime, winc, binc)
+			for engine in engines:
+				start_search(engine, pos_string, moves_string, limited(engine, go))
+			results = read_searches(engines)
 
-		try:
-			while 1:
-				msg = sf.output.get(block = False)
-				tokens = msg.split()
-
-				if "score cp" in msg and "lowerbound" not in msg and "upperbound" not in msg:
-					score_index = tokens.index("cp") + 1
-					sf_score = int(tokens[score_index])
-				elif "score mate" in msg:
-					mate_index = tokens.index("mate") + 1
-					mate_in = int(tokens[mate_index])
-					if mate_in > 0:
-						sf_score = 1000000 - (mate_in * 1000)
+		else:
+
+			# One engine after the other, each with the whole machine, so we must split the clock ourselves.
+
+			budget = time_budget(board, wtime, btime, winc, binc)
+			lz_time = max(1, int(budget * config["sequential_leela_share"]))
+			others_time = max(1, (budget - lz_time) // (len(engines) - 1))
+
+			start_search(lz, pos_string, moves_string, limited(lz, "go movetime {}".format(lz_time)))
+			lz_result = read_searches([lz])[0]
+
+			if mode == "verify":
+				decision = verify(board, pos_string, moves_string, lz_result, budget - lz_time)
+			else:
+				results = []
+
+				for engine in engines:
+					if engine is lz:
+						results.append(lz_result)
 					else:
-						sf_score = -1000000 + (-mate_in * 1000)
-				elif "bestmove" in msg:
-					sf_move = tokens[1]
-					break
+						start_search(engine, pos_string, moves_string, limited(engine, "go movetime {}".format(others_time)))
+						results.append(read_searches([engine])[0])
 
-		except queue.Empty:
-			pass
+		if mode != "verify":
+			decision = aggregate(board, list(zip(engines, results)))
 
-		time.sleep(0.01)		# Avoid the pure spinlock
+		# No engine gave us a legal move, e.g. because it has the wrong idea of the variant.
+		# Rather than play something arbitrary, have the primary choose among the legal moves.
+
+		if decision["move"] is None and legal_moves:
+			budget = time_budget(board, wtime, btime, winc, binc) // 4
+			go = "{} searchmoves {}".format(limited(lz, "go movetime {}".format(max(1, budget))), " ".join(legal_moves))
+			start_search(lz, pos_string, moves_string, go)
+			mv = read_searches([lz])[0]["move"]
+			log("   Rescue: {}".format(mv))
+			decision.update(move = legal_choice(board, [mv]), source = "lc0")
 
-	if lz_move == sf_move:
-		log("   Agreed: {} ({}/{})".format(lz_move, lz_score, sf_score))
-		return lz_move
+	return decision
 
-	if lz_score is not None and sf_score is not None:
-		if sf_score > lz_score + config["veto_cp"] or sf_score > config["takeover_cp"]:
-			log("Stockfish: {} ({})".format(sf_move, sf_score))
-			return sf_move
+def quick_move(pos_string, moves_string):
 
-	log("      Lc0: {} ({})".format(lz_move, lz_score))
-	return lz_move
+	# A shallow two-line Stockfish search. If the best move beats the runner-up by quick_margin_cp
+	# (typically a recapture) there's nothing to think about, so it's returned; otherwise None.
+	# The caller must hold the sf lease.
 
-def book_move(moves_string):
+	sf.send("setoption name MultiPV value 2")
+	start_search(sf, pos_string, moves_string, "go depth {}".format(config["quick_depth"]))
 
-	mslen = len(moves_string.split())
+	scores = dict()			# multipv index --> latest score
+	best = None
 
-	candidate_moves = set()
+	while best is None:
+		msg = sf.output.get()
+		tokens = msg.split()
+		if tokens[0:1] == ["bestmove"]:
+			best = tokens[1]
+			sf.searching = False
+		elif "multipv" in tokens:
+			result = new_result()
+			parse_output(sf, msg, result)
+			if result["score"] is not None:
+				scores[int(tokens[tokens.index("multipv") + 1])] = result["score"]
+
+	sf.send("setoption name MultiPV value {}".format(sf.spec.get("options", {}).get("MultiPV", 1)))
+
+	if 1 in scores and 2 in scores and scores[1] - scores[2] >= config["quick_margin_cp"]:
+		return best
+
+	return None
+
+def aggregate(board, pairs):
+
+	# Turns the (engine, result) pairs into a decision according to the aggregation policy:
+	#
+	#	veto		-- the primary's move, unless a checker thinks its own move is better by veto_cp
+	#				   or is winning by takeover_cp (the original rule, for any number of checkers)
+	#	vote		-- the move with the most total weight; the primary's move wins ties
+	#	takeover	-- the primary's move, unless some engine's score is above takeover_cp
+
+	primary = [result for engine, result in pairs if engine is lz][0]
+	checkers = [(engine, result) for engine, result in pairs if engine is not lz]
+
+	decision = {"lz": primary, "sf": checkers[0][1], "results": {engine.shortname: result for engine, result in pairs}}
+	fallbacks = [primary["move"]] + [result["move"] for engine, result in checkers]
+
+	moves = [result["move"] for engine, result in pairs]
+
+	if all(mv == moves[0] for mv in moves):
+		log("   Agreed: {} ({})".format(moves[0], "/".join(str(result["score"]) for engine, result in pairs)))
+		decision.update(move = legal_choice(board, [moves[0]]), source = "agreed")
+		return decision
+
+	policy = config["aggregation"]
+
+	if policy == "vote":
+
+		tally = dict()
+		for engine, result in pairs:
+			if result["move"]:
+				tally[result["move"]] = tally.get(result["move"], 0) + engine.spec.get("weight", 1)
+
+		best = max(tally.values())
+		winners = [mv for mv in tally if tally[mv] == best]
+		mv = primary["move"] if primary["move"] in winners else winners[0]
+
+		log("     Vote: {} {}".format(mv, tally))
+		decision.update(move = legal_choice(board, [mv] + fallbacks), source = "lc0" if mv == primary["move"] else "vote")
+		return decision
+
+	if primary["score"] is not None:
+
+		overriders = []
+
+		for engine, result in checkers:
+			if result["score"] is None:
+				continue
+			if result["score"] > config["takeover_cp"] or (policy == "veto" and result["score"] > primary["score"] + config["veto_cp"]):
+				overriders.append((engine, result))
+
+		if overriders:
+			engine, result = max(overriders, key = lambda pair: pair[1]["score"])
+			log("{:>9}: {} ({})".format(engine.shortname, result["move"], result["score"]))
+			decision.update(move = legal_choice(board, [result["move"]] + fallbacks), source = "sf")
+			return decision
+
+	log("{:>9}: {} ({})".format(lz.shortname, primary["move"], primary["score"]))
+	decision.update(move = legal_choice(board, fallbacks), source = "lc0")
+	return decision
+
+def verify(board, pos_string, moves_string, lz_result, sf_time):
+
+	# As the old Engine.validate(): Stockfish finds its own best move, and only if that differs
+	# from Leela's does it also score Leela's move, so both scores are on the same scale.
+	# The caller must hold the sf lease.
+
+	go = limited(sf, "go movetime {}".format(max(1, sf_time // 2)))
+
+	start_search(sf, pos_string, moves_string, go)
+	sf_result = read_searches([sf])[0]
+
+	if sf_result["move"] == lz_result["move"] or lz_result["move"] is None:
+		return aggregate(board, [(lz, lz_result), (sf, sf_result)])
+
+	start_search(sf, pos_string, moves_string, "{} searchmoves {}".format(go, lz_result["move"]))
+	test_result = read_searches([sf])[0]
+
+	best_score = sf_result["score"]
+	test_score = test_result["score"]
+
+	decision = {"lz": lz_result, "sf": sf_result, "results": {lz.shortname: lz_result, sf.shortname: sf_result}}
+
+	if best_score is not None and test_score is not None:
+		if best_score > test_score + config["veto_cp"] or best_score > config["takeover_cp"]:
+			log("Stockfish: {} ({} vs {})".format(sf_result["move"], best_score, test_score))
+			decision.update(move = legal_choice(board, [sf_result["move"], lz_result["move"]]), source = "sf")
+			return decision
+
+	log("      Lc0: {} ({} vs {})".format(lz_result["move"], test_score, best_score))
+	decision.update(move = legal_choice(board, [lz_result["move"], sf_result["move"]]), source = "lc0")
+	return decision
+
+def limited(engine, go):
+
+	# In "nodes" mode the clock is ignored, so the same position always gets the same search.
+
+	if config["search_limit"] == "nodes":
+		return "go nodes {}".format(engine.spec["nodes"])
+	return go
+
+def time_budget(board, wtime, btime, winc, binc):
+
+	# Milliseconds we'll spend on this move when we're managing the clock ourselves.
+
+	if board.active == "w":
+		mytime, myinc = wtime, winc
+	else:
+		mytime, myinc = btime, binc
+
+	return max(100, min(mytime // 2, mytime // config["moves_to_go"] + myinc * 3 // 4))
+
+def start_search(engine, pos_string, moves_string, go):
+
+	engine.send("position {} moves {}".format(pos_string, moves_string))
+	engine.send(go)
+
+def new_result():
+	return {"move": None, "score": None, "depth": None, "nodes": None, "nps": None, "time": None, "hashfull": None}
+
+def parse_output(engine, msg, result):
+
+	# Updates the search result from one line of engine output. Returns True on bestmove.
+
+	tokens = msg.split()
+
+	if "score cp" in msg and "lowerbound" not in msg and "upperbound" not in msg:
+		score_index = tokens.index("cp") + 1
+		result["score"] = int(tokens[score_index])
+	elif "score mate" in msg:
+		mate_index = tokens.index("mate") + 1
+		mate_in = int(tokens[mate_index])
+		if mate_in > 0:
+			result["score"] = 1000000 - (mate_in * 1000)
+		else:
+			result["score"] = -1000000 + (-mate_in * 1000)
+	elif "bestmove" in msg:
+		result["move"] = tokens[1]
+		engine.searching = False
+		return True
+
+	if tokens[0:1] == ["info"]:
+		for key in ["depth", "nodes", "nps", "time", "hashfull"]:
+			if key in tokens:
+				try:
+					result[key] = int(tokens[tokens.index(key) + 1])
+				except (IndexError, ValueError):
+					pass
+
+	return False
+
+def read_searches(engines):
+
+	# Reads the engines' output until each has given a bestmove. The caller must hold their leases.
+
+	results = [new_result() for engine in engines]
+
+	while any(result["move"] is None for result in results):
+
+		for engine, result in zip(engines, results):
+
+			if result["move"] is not None:
+				continue
+
+			# Read all available info...
 
-	for line in book:
-		if line.startswith(moves_string) and len(line) > len(moves_string):
 			try:
-				candidate_moves.add(line.split()[mslen])
-			except:
-				pass	# Some extra whitespace in the string?
+				while 1:
+					msg = engine.output.get(block = False)
+					if parse_output(engine, msg, result):
+						break
+			except queue.Empty:
+				pass
+
+		time.sleep(0.01)		# Avoid the pure spinlock
+
+	return results
+
+def legal_choice(board, candidates):
+
+	# Never submit an illegal move: the first legal one of the candidates, or None.
+
+	for mv in candidates:
+		if board.is_legal(mv):
+			return mv
+		log("WARNING: rejecting illegal move {}".format(mv), "warning")
 
-	if len(candidate_moves) == 0:
+	return None
+
+def make_book_index(lines):
+
+	# Maps the hash of every book position to the set of book moves from it.
+	# Lines are move sequences from the standard starting position.
+
+	index = dict()
+
+	for line in lines:
+		board = Board()
+		try:
+			for mv in line.split():
+				index.setdefault(board.hash(), set()).add(mv)
+				board.move(mv)
+		except Exception:
+			log("Bad book line: {}".format(line))
+
+	return index
+
+def book_move(board):
+
+	candidate_moves = book_index.get(board.hash())
+
+	if not candidate_moves:
 		return None
 
 	ret = random.choice(list(candidate_moves))
@@ -473,6 +1787,1023 @@ def book_move(moves_string):
 	log("     Book: {} {}".format(ret, alts))
 	return ret
 
+# ---------------------------------------------------------------------------------------------------------
+# Profiling. Stages of a game: opponent (waiting for their move), stream (waiting for any other
+# line), decode, update (diffing onto the board), book, movegen, engines (lease + search), post,
+# and move (our whole turn).
+
+class Timings():
+
+	def __init__(self):
+		self.samples = dict()			# stage --> list of seconds
+
+	def add(self, stage, secs):
+		self.samples.setdefault(stage, []).append(secs)
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - start)
+
+	def summary(self):
+
+		lines = ["{:<10} {:>6} {:>10} {:>10} {:>10} {:>10}".format("stage", "count", "p50 ms", "p95 ms", "p99 ms", "total s")]
+
+		for stage, values in self.samples.items():
+			values = sorted(values)
+			lines.append("{:<10} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(stage, len(values),
+				percentile(values, 50) * 1000, percentile(values, 95) * 1000, percentile(values, 99) * 1000, sum(values)))
+
+		return "\n".join(lines)
+
+def percentile(sorted_values, p):
+
+	# Nearest-rank percentile.
+
+	if len(sorted_values) == 0:
+		return 0
+	rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+	return sorted_values[rank - 1]
+
+def timed(timings, stage):
+
+	if timings is None:
+		return contextlib.nullcontext()
+	return timings.stage(stage)
+
+class Sampler():
+
+	# A sampling profiler for one thread: every interval we look at its current stack and count
+	# the functions on it. Cheap enough to leave on, unlike cProfile.
+
+	def __init__(self, thread_ident, interval):
+
+		self.thread_ident = thread_ident
+		self.interval = interval
+		self.leaf = dict()				# function --> samples where it was running
+		self.inclusive = dict()			# function --> samples where it was anywhere on the stack
+		self.count = 0
+		self.running = True
+
+		threading.Thread(target = self.loop, daemon = True).start()
+
+	def loop(self):
+
+		while self.running:
+
+			time.sleep(self.interval)
+
+			frame = sys._current_frames().get(self.thread_ident)
+			if frame is None:
+				continue
+
+			self.count += 1
+			seen = set()
+			leaf = True
+
+			while frame is not None:
+				name = "{}:{}".format(frame.f_code.co_name, frame.f_lineno if leaf else frame.f_code.co_firstlineno)
+				if leaf:
+					self.leaf[name] = self.leaf.get(name, 0) + 1
+					leaf = False
+				func = frame.f_code.co_name
+				if func not in seen:
+					seen.add(func)
+					self.inclusive[func] = self.inclusive.get(func, 0) + 1
+				frame = frame.f_back
+
+	def stop(self):
+
+		self.running = False
+
+		lines = ["Profile: {} samples".format(self.count)]
+
+		for title, counts in [("running", self.leaf), ("on stack", self.inclusive)]:
+			lines.append("  Top {}:".format(title))
+			for name, n in sorted(counts.items(), key = lambda item: -item[1])[:15]:
+				lines.append("    {:>6.1%}  {}".format(n / max(1, self.count), name))
+
+		return "\n".join(lines)
+
+# ---------------------------------------------------------------------------------------------------------
+# Analysis: python lszf.py analyse -- batch positions searched by a pool of dedicated Lc0s.
+#
+# A UCI engine runs one search at a time, so the NN batching happens within each search; what we
+# can do is keep every Lc0 busy back-to-back with large minibatches.
+
+def submit_analysis(fen, moves_string, nodes = None):
+
+	job = {
+		"fen": fen,
+		"moves": moves_string,
+		"nodes": nodes or config["analysis_nodes"],
+		"result": None,
+		"done": threading.Event(),
+	}
+
+	analysis_queue.put(job)
+	return job
+
+def start_analysis():
+
+	# Starts the analysis workers. Their instances get the analysis options, e.g. a bigger
+	# MinibatchSize, since throughput matters more than latency here.
+
+	global analysis_queue
+
+	analysis_queue = queue.Queue()
+
+	primary = engine_specs()[primary_index(engine_specs())]
+
+	options = dict(primary.get("options", {}))
+	options.update(config["analysis_leela_options"])
+
+	for n in range(max(1, config["analysis_instances"])):
+		spec = dict(primary, name = "{}-A{}".format(primary["name"], n), options = options, cpus = None)
+		engine = start_engine(spec, None)
+		threading.Thread(target = analysis_worker, args = (engine, ), daemon = True).start()
+
+def analysis_worker(engine):
+
+	while 1:
+
+		job = analysis_queue.get()
+
+		pos_string = "startpos" if job["fen"] == "startpos" else "fen " + job["fen"]
+
+		try:
+			with engine.lease("analysis"):
+				start_search(engine, pos_string, job["moves"], "go nodes {}".format(job["nodes"]))
+				job["result"] = read_searches([engine])[0]
+		except Exception as err:
+			log("Exception in analysis_worker(): {}".format(repr(err)))
+
+		job["done"].set()
+
+def analyse(args):
+
+	# python lszf.py analyse [positions.json] -- each position is searched to analysis_nodes
+	# and printed as a line of JSON. The file format is the same as the bench file.
+
+	start_analysis()
+
+	positions = load_bench_positions(args[0] if args else BENCH_FILE)
+	jobs = [submit_analysis(fen, moves_string) for fen, moves_string, board in positions]
+
+	for job in jobs:
+		job["done"].wait()
+		result = job["result"] or new_result()
+		log(json.dumps({"fen": job["fen"], "moves": job["moves"], "bestmove": result["move"], "score": result["score"],
+			"depth": result["depth"], "nodes": result["nodes"]}))
+
+# ---------------------------------------------------------------------------------------------------------
+# Game archive. ARCHIVE_FILE is append-only, one binary record per game:
+#
+#	"LA" version:u8 length:varint body
+#
+#	body:		strings gameId white black variant initialFen status winner (varint length + utf-8)
+#				varint date (unix secs), varint initial clock (secs), varint increment (secs), u8 our colour (0 = white)
+#				varint plies, then a u16 per move (from | to << 6 | promotion << 12)
+#				per ply, the mover's clock in centiseconds as a zigzag delta from that side's previous clock
+#				varint decisions, each: varint ply, u8 source, score lz, score sf (0 = none, else zigzag + 1), u16 lz move, u16 sf move
+#
+# ARCHIVE_INDEX_FILE has a line of JSON per record (id, opponent, date, offset, length) so we can
+# find games by opponent or date without decoding everything.
+
+ARCHIVE_VERSION = 1
+DECISION_SOURCES = ["book", "agreed", "lc0", "sf", "forced", "quick", "prep", "vote"]
+PROMOTIONS = " qrbn"
+
+def encode_varint(n):
+
+	ret = bytearray()
+	while n >= 0x80:
+		ret.append((n & 0x7f) | 0x80)
+		n >>= 7
+	ret.append(n)
+	return bytes(ret)
+
+def decode_varint(data, pos):
+
+	ret = 0
+	shift = 0
+	while 1:
+		b = data[pos]
+		pos += 1
+		ret |= (b & 0x7f) << shift
+		if b < 0x80:
+			return ret, pos
+		shift += 7
+
+def zigzag(n):
+	return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+	return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+def encode_score(score):
+	return encode_varint(0 if score is None else zigzag(score) + 1)
+
+def decode_score(data, pos):
+	n, pos = decode_varint(data, pos)
+	return (None if n == 0 else unzigzag(n - 1)), pos
+
+def encode_string(s):
+	b = (s or "").encode("utf-8")
+	return encode_varint(len(b)) + b
+
+def decode_string(data, pos):
+	n, pos = decode_varint(data, pos)
+	return data[pos:pos + n].decode("utf-8"), pos + n
+
+def encode_move(mv):
+
+	if not mv or len(mv) < 4:
+		return struct.pack("<H", 0xffff)
+	code = square_index(mv[0:2]) | (square_index(mv[2:4]) << 6) | (PROMOTIONS.index(mv[4:5] or " ") << 12)
+	return struct.pack("<H", code)
+
+def decode_move(code):
+
+	if code == 0xffff:
+		return None
+	return square_name(code & 63) + square_name((code >> 6) & 63) + PROMOTIONS[code >> 12].strip()
+
+def player_name(player):
+	return player.get("name") or "AI level {}".format(player.get("aiLevel", "?"))
+
+def encode_game(game):
+
+	gameFull = game.gameFull
+	clock = gameFull.get("clock") or {}
+
+	body = bytearray()
+
+	for s in [game.gameId, player_name(gameFull["white"]), player_name(gameFull["black"]), gameFull["variant"]["key"],
+			gameFull["initialFen"], game.status, game.winner]:
+		body += encode_string(s)
+
+	body += encode_varint(int(gameFull.get("createdAt", time.time() * 1000) // 1000))
+	body += encode_varint(clock.get("initial", 0) // 1000)
+	body += encode_varint(clock.get("increment", 0) // 1000)
+	body.append(0 if game.colour == "white" else 1)
+
+	moves = game.board.moves
+	body += encode_varint(len(moves))
+
+	for mv in moves:
+		body += encode_move(mv)
+
+	# The first move's side is whoever was to move at the start; the sides then alternate.
+
+	first_white = (game.board.active == "w") == (len(moves) % 2 == 0)
+	previous = [clock.get("initial", 0) // 10, clock.get("initial", 0) // 10]
+
+	for ply, ms in enumerate(game.clocks):
+		side = (ply + (0 if first_white else 1)) % 2
+		cs = previous[side] if ms is None else ms // 10
+		body += encode_varint(zigzag(cs - previous[side]))
+		previous[side] = cs
+
+	body += encode_varint(len(game.decisions))
+
+	for ply, decision in game.decisions:
+		lz_result = decision["lz"] or new_result()
+		sf_result = decision["sf"] or new_result()
+		body += encode_varint(ply)
+		body.append(DECISION_SOURCES.index(decision["source"]) if decision["source"] in DECISION_SOURCES else 255)
+		body += encode_score(lz_result["score"])
+		body += encode_score(sf_result["score"])
+		body += encode_move(lz_result["move"])
+		body += encode_move(sf_result["move"])
+
+	return b"LA" + bytes([ARCHIVE_VERSION]) + encode_varint(len(body)) + bytes(body)
+
+def decode_game(data):
+
+	if data[0:2] != b"LA" or data[2] != ARCHIVE_VERSION:
+		raise ValueError("not an archive record")
+
+	length, pos = decode_varint(data, 3)
+	ret = dict()
+
+	for key in ["id", "white", "black", "variant", "initialFen", "status", "winner"]:
+		ret[key], pos = decode_string(data, pos)
+
+	ret["date"], pos = decode_varint(data, pos)
+	ret["initial"], pos = decode_varint(data, pos)
+	ret["increment"], pos = decode_varint(data, pos)
+	ret["colour"] = "white" if data[pos] == 0 else "black"
+	pos += 1
+
+	plies, pos = decode_varint(data, pos)
+	ret["moves"] = [decode_move(code) for code in struct.unpack_from("<{}H".format(plies), data, pos)]
+	pos += plies * 2
+
+	first_white = Board(ret["initialFen"]).active == "w"
+	previous = [ret["initial"] * 100, ret["initial"] * 100]
+	ret["clocks"] = []
+
+	for ply in range(plies):
+		side = (ply + (0 if first_white else 1)) % 2
+		delta, pos = decode_varint(data, pos)
+		previous[side] += unzigzag(delta)
+		ret["clocks"].append(previous[side] * 10)
+
+	count, pos = decode_varint(data, pos)
+	ret["decisions"] = []
+
+	for n in range(count):
+		ply, pos = decode_varint(data, pos)
+		source = DECISION_SOURCES[data[pos]] if data[pos] < len(DECISION_SOURCES) else "?"
+		pos += 1
+		lz_score, pos = decode_score(data, pos)
+		sf_score, pos = decode_score(data, pos)
+		lz_move, sf_move = struct.unpack_from("<HH", data, pos)
+		pos += 4
+		ret["decisions"].append({"ply": ply, "source": source, "lz_score": lz_score, "sf_score": sf_score,
+			"lz_move": decode_move(lz_move), "sf_move": decode_move(sf_move)})
+
+	return ret
+
+def archive_game(game):
+
+	record = encode_game(game)
+	opponent = player_name(game.gameFull["black" if game.colour == "white" else "white"])
+
+	with archive_MUTEX:
+
+		with open(ARCHIVE_FILE, "ab") as outfile:
+			offset = outfile.tell()
+			outfile.write(record)
+
+		entry = {"id": game.gameId, "opponent": opponent, "date": int(game.gameFull.get("createdAt", time.time() * 1000) // 1000),
+			"offset": offset, "length": len(record)}
+
+		with open(ARCHIVE_INDEX_FILE, "a") as outfile:
+			outfile.write(json.dumps(entry) + "\n")
+
+	log("Archived game {} ({} bytes)".format(game.gameId, len(record)))
+
+def read_archive_index(opponent = None, since = 0):
+
+	ret = []
+
+	try:
+		with open(ARCHIVE_INDEX_FILE) as infile:
+			for line in infile:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					continue			# e.g. a line cut short by a crash
+				if opponent is not None and entry["opponent"].lower() != opponent.lower():
+					continue
+				if entry["date"] < since:
+					continue
+				ret.append(entry)
+	except FileNotFoundError:
+		pass
+
+	return ret
+
+def read_archived_games(entries):
+
+	if not entries:
+		return
+
+	with open(ARCHIVE_FILE, "rb") as infile:
+		for entry in entries:
+			infile.seek(entry["offset"])
+			yield decode_game(infile.read(entry["length"]))
+
+def list_archive(args):
+
+	# python lszf.py archive [opponent]
+
+	entries = read_archive_index(args[0] if args else None)
+
+	if not entries:
+		log("No archived games")
+		return
+
+	for g in read_archived_games(entries):
+		log("{} {} {} vs {} -- {} {} ({} plies, {}+{})".format(time.strftime("%Y-%m-%d %H:%M", time.localtime(g["date"])), g["id"],
+			g["white"], g["black"], g["status"], g["winner"] or "", len(g["moves"]), g["initial"], g["increment"]))
+
+# ---------------------------------------------------------------------------------------------------------
+# Opponent prep. When a challenge comes in, we look at the archived games against that opponent
+# and cache our answers to the positions they've led us into, so a repeated line costs no search.
+# Only moves both engines agreed on are cached, so the cache never skips a Stockfish veto.
+
+def opponent_stats(games, opponent):
+
+	wins, draws, losses = 0, 0, 0
+
+	for g in games:
+		if not g["winner"]:
+			draws += 1
+		elif g["winner"] == g["colour"]:
+			wins += 1
+		else:
+			losses += 1
+
+	return "{}: {} games, +{} ={} -{}".format(opponent, len(games), wins, draws, losses)
+
+def start_prep(opponent):
+
+	if not config["prep"]:
+		return
+
+	with prep_MUTEX:
+		if opponent in prep_warming:
+			return
+		prep_warming.add(opponent)
+
+	threading.Thread(target = warm_prep, args = (opponent, ), daemon = True).start()
+
+def warm_prep(opponent):
+
+	engines_ready.wait()
+
+	try:
+		games = list(read_archived_games(read_archive_index(opponent)[-config["prep_games"]:]))
+		if games:
+			log("Prep -- " + opponent_stats(games, opponent))
+			prep_from_games(games, opponent)
+	except Exception as err:
+		log("Exception in warm_prep(): {}".format(repr(err)))
+	finally:
+		with prep_MUTEX:
+			prep_warming.discard(opponent)
+
+def prep_from_games(games, opponent):
+
+	todo = []
+	seeded = 0
+
+	for g in games:
+
+		if g["variant"] != "standard":
+			continue
+
+		board = Board(g["initialFen"])
+		decisions = {d["ply"]: d for d in g["decisions"]}
+
+		for ply, mv in enumerate(g["moves"][:config["prep_plies"]]):
+
+			d = decisions.get(ply)
+
+			if d and board.hash() not in prep_cache:
+
+				# Positions where the engines agreed last time need no new search...
+
+				if d["source"] == "agreed" and board.is_legal(d["lz_move"]):
+					cache_prep(board.hash(), d["lz_move"], {"move": d["lz_move"], "score": d["lz_score"]}, {"move": d["sf_move"], "score": d["sf_score"]})
+					seeded += 1
+				elif d["source"] not in ["book", "forced"]:
+					todo.append((g["initialFen"], " ".join(g["moves"][:ply]), board.copy()))
+
+			board.move(mv)
+
+	log("Prep -- {}: {} positions from the archive, {} to search".format(opponent, seeded, len(todo)))
+
+	# The rest get short searches, but only until the game actually starts.
+
+	for fen, moves_string, board in todo:
+
+		if board.hash() in prep_cache:
+			continue
+
+		results = prep_search(fen, moves_string)
+
+		if results is None:
+			log("Prep -- {}: stopped, game starting".format(opponent))
+			return
+		lz_result = results[engines.index(lz)]
+		sf_result = results[engines.index(sf)]
+
+		if all(result["move"] == lz_result["move"] for result in results) and board.is_legal(lz_result["move"]):
+			cache_prep(board.hash(), lz_result["move"], lz_result, sf_result)
+
+def prep_search(fen, moves_string):
+
+	# Returns None if a game has started: checked only once we hold the leases, since the game
+	# may have been waiting for them.
+
+	pos_string = "startpos" if fen == "startpos" else "fen " + fen
+
+	with leases(engines, "prep"):
+		with active_game_MUTEX:
+			if active_game:
+				return None
+		for engine in engines:
+			engine.send("setoption name UCI_Chess960 value false")
+			start_search(engine, pos_string, moves_string, "go nodes {}".format(engine.spec["prep_nodes"]))
+		return read_searches(engines)
+
+def cache_prep(key, mv, lz_result, sf_result):
+
+	with prep_MUTEX:
+		while len(prep_cache) >= config["prep_cache_size"]:
+			del prep_cache[next(iter(prep_cache))]			# Oldest first
+		prep_cache[key] = {"move": mv, "lz": lz_result, "sf": sf_result}
+
+# ---------------------------------------------------------------------------------------------------------
+# Benchmarking: python lszf.py bench [--nodes] [mode ...]
+
+def load_bench_positions(filename = BENCH_FILE):
+
+	# Each entry is a FEN, or an object with "fen" (default startpos) and "moves".
+
+	try:
+		entries = load_json(filename)
+	except (FileNotFoundError, json.decoder.JSONDecodeError):
+		print("Couldn't load {}".format(filename))
+		return []
+
+	ret = []
+
+	for entry in entries:
+		if isinstance(entry, str):
+			entry = {"fen": entry}
+		fen = entry.get("fen", "startpos")
+		moves_string = entry.get("moves", "")
+		board = Board(fen)
+		for mv in moves_string.split():
+			board.move(mv)
+		ret.append((fen, moves_string, board))
+
+	return ret
+
+def bench(args):
+
+	# Runs every bench position through the full decision pipeline, once per search mode.
+	# With --nodes the engines search a fixed number of nodes (each engine's "nodes" setting), so
+	# runs are repeatable (given Threads = 1) and their per-position moves can be diffed.
+	# The engines are set up (pinning, Threads) for the configured search_mode, for all modes.
+
+	global book_index
+
+	if "--nodes" in args:
+		config["search_limit"] = "nodes"
+
+	modes = [arg for arg in args if not arg.startswith("--")] or ["parallel", "sequential"]
+	positions = load_bench_positions()
+
+	book_index = dict()			# We want searches, not book moves
+
+	start_engines()
+
+	summary = []
+
+	for mode in modes:
+
+		config["search_mode"] = mode
+		stats = {"lz": [], "sf": [], "time": [], "sources": dict()}
+
+		for n, (fen, moves_string, board) in enumerate(positions):
+
+			with leases(engines, "bench"):
+				for engine in engines:
+					engine.send("ucinewgame")
+
+			start = time.monotonic()
+			decision = genmove(board, fen, moves_string, 60000, 60000, 1000, 1000)
+			elapsed = time.monotonic() - start
+
+			stats["time"].append(elapsed)
+			stats["sources"][decision["source"]] = stats["sources"].get(decision["source"], 0) + 1
+
+			for key in ["lz", "sf"]:
+				if decision[key]:
+					stats[key].append(decision[key])
+
+			log("{} #{:<3} {:<6} {:<7} {:.3f}s".format(mode, n, decision["move"], decision["source"], elapsed))
+
+		summary.append((mode, stats))
+
+	log("")
+	log("{:<12} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}  {}".format("mode", "secs", "max", "lz depth", "lz nps", "sf depth", "sf nps", "decisions"))
+
+	for mode, stats in summary:
+		log("{:<12} {:>8.3f} {:>8.3f} {:>10} {:>10} {:>10} {:>10}  {}".format(mode, mean(stats["time"]), max(stats["time"] or [0]),
+			mean_of(stats["lz"], "depth"), mean_of(stats["lz"], "nps"), mean_of(stats["sf"], "depth"), mean_of(stats["sf"], "nps"),
+			" ".join("{}:{}".format(key, val) for key, val in sorted(stats["sources"].items()))))
+
+def mean(values):
+
+	if len(values) == 0:
+		return 0
+	return sum(values) / len(values)
+
+def mean_of(results, key):
+
+	values = [result[key] for result in results if result[key] is not None]
+	return round(mean(values), 1)
+
+# ---------------------------------------------------------------------------------------------------------
+# Minimal board model, enough to follow the game, check legality and hash positions.
+
+KNIGHT_STEPS = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+KING_STEPS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+ROOK_DIRS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+BISHOP_DIRS = [(1, 1), (-1, 1), (-1, -1), (1, -1)]
+
+zobrist_rng = random.Random(20180501)
+ZOBRIST_PIECES = {piece: [zobrist_rng.getrandbits(64) for n in range(64)] for piece in "KQRBNPkqrbnp"}
+ZOBRIST_CASTLING = [zobrist_rng.getrandbits(64) for n in range(64)]
+ZOBRIST_ENPASSANT = [zobrist_rng.getrandbits(64) for n in range(8)]
+ZOBRIST_BLACK = zobrist_rng.getrandbits(64)
+
+def square_name(sq):
+	return "abcdefgh"[sq % 8] + str(sq // 8 + 1)
+
+def square_index(s):
+	x = ord(s[0]) - 97
+	y = int(s[1]) - 1
+	if x < 0 or x > 7 or y < 0 or y > 7:
+		raise ValueError("bad square {}".format(s))
+	return y * 8 + x
+
+class Board():
+
+	# squares[y * 8 + x] with a1 = 0 and h8 = 63. Pieces are "KQRBNP" / "kqrbnp" and empty squares are "".
+	# Castling rights are stored as the squares of the rooks that can still castle, which covers Chess960.
+
+	def __init__(self, fen = "startpos", chess960 = False):
+
+		self.chess960 = chess960
+		self.moves = []
+		self.history = []
+
+		if fen == "startpos":
+			fen = START_FEN
+
+		tokens = fen.split()
+		while len(tokens) < 6:
+			tokens.append(["w", "-", "-", "0", "1"][len(tokens) - 1])
+
+		self.squares = [""] * 64
+
+		rows = tokens[0].split("/")
+		if len(rows) != 8:
+			raise ValueError("bad FEN {}".format(fen))
+
+		for i, row in enumerate(rows):
+			y = 7 - i
+			x = 0
+			for c in row:
+				if c.isdigit():
+					x += int(c)
+				elif c in ZOBRIST_PIECES and x < 8:
+					self.squares[y * 8 + x] = c
+					x += 1
+				else:
+					raise ValueError("bad FEN {}".format(fen))
+
+		self.active = tokens[1]
+		self.castling = []
+
+		for c in tokens[2]:
+			if c == "-":
+				continue
+			rank = 0 if c.isupper() else 7
+			rook = "R" if c.isupper() else "r"
+			king = "K" if c.isupper() else "k"
+			files = [x for x in range(8) if self.squares[rank * 8 + x] == rook]
+			king_files = [x for x in range(8) if self.squares[rank * 8 + x] == king]
+			if c in "KQkq":
+				if not king_files:
+					continue
+				if c in "Kk":
+					files = [x for x in files if x > king_files[0]][-1:]
+				else:
+					files = [x for x in files if x < king_files[0]][:1]
+			else:
+				files = [x for x in files if x == ord(c.lower()) - 97]
+			for x in files:
+				self.castling.append(rank * 8 + x)
+
+		self.enpassant = None if tokens[3] == "-" else square_index(tokens[3])
+		self.halfmove = int(tokens[4])
+		self.fullmove = int(tokens[5])
+
+	def copy(self):
+
+		ret = Board.__new__(Board)
+		ret.chess960 = self.chess960
+		ret.moves = []
+		ret.history = []
+		ret.squares = self.squares[:]
+		ret.active = self.active
+		ret.castling = self.castling[:]
+		ret.enpassant = self.enpassant
+		ret.halfmove = self.halfmove
+		ret.fullmove = self.fullmove
+		return ret
+
+	def piece_at(self, x, y):
+
+		if x < 0 or x > 7 or y < 0 or y > 7:
+			return None
+		return self.squares[y * 8 + x]
+
+	def castling_rook(self, src, dst):
+
+		# Returns the rook square if src -> dst is a castling move, accepting both
+		# king-takes-rook notation and (in standard chess) the usual e1g1 form.
+
+		piece = self.squares[src]
+		if piece not in ["K", "k"]:
+			return None
+
+		rook = "R" if piece == "K" else "r"
+
+		if self.squares[dst] == rook:
+			return dst
+
+		if not self.chess960 and src % 8 == 4 and src // 8 == dst // 8 and abs(dst % 8 - 4) == 2:
+			rook_sq = (src // 8) * 8 + (7 if dst % 8 == 6 else 0)
+			if self.squares[rook_sq] == rook:
+				return rook_sq
+
+		return None
+
+	def move(self, mv):
+
+		src = square_index(mv[0:2])
+		dst = square_index(mv[2:4])
+		promotion = mv[4:5]
+
+		piece = self.squares[src]
+		if not piece:
+			raise ValueError("no piece for move {}".format(mv))
+
+		white = piece.isupper()
+
+		self.history.append((self.squares[:], self.active, self.castling[:], self.enpassant, self.halfmove, self.fullmove))
+		self.moves.append(mv)
+
+		rook_sq = self.castling_rook(src, dst)
+
+		if rook_sq is not None:
+
+			rank = src // 8
+			kingside = rook_sq % 8 > src % 8
+			rook = self.squares[rook_sq]
+			self.squares[src] = ""
+			self.squares[rook_sq] = ""
+			self.squares[rank * 8 + (6 if kingside else 2)] = piece
+			self.squares[rank * 8 + (5 if kingside else 3)] = rook
+			self.enpassant = None
+			self.halfmove += 1
+
+		else:
+
+			capture = self.squares[dst] != ""
+
+			if piece in ["P", "p"] and dst == self.enpassant and src % 8 != dst % 8:
+				self.squares[(src // 8) * 8 + dst % 8] = ""
+				capture = True
+
+			self.squares[src] = ""
+			self.squares[dst] = piece
+
+			if promotion:
+				self.squares[dst] = promotion.upper() if white else promotion.lower()
+
+			if piece in ["P", "p"] and abs(dst - src) == 16:
+				self.enpassant = (src + dst) // 2
+			else:
+				self.enpassant = None
+
+			if capture or piece in ["P", "p"]:
+				self.halfmove = 0
+			else:
+				self.halfmove += 1
+
+		if piece in ["K", "k"]:
+			rank = 0 if white else 7
+			self.castling = [sq for sq in self.castling if sq // 8 != rank]
+
+		self.castling = [sq for sq in self.castling if sq != src and sq != dst]
+
+		if self.active == "b":
+			self.fullmove += 1
+
+		self.active = "b" if self.active == "w" else "w"
+
+	def undo(self):
+
+		self.squares, self.active, self.castling, self.enpassant, self.halfmove, self.fullmove = self.history.pop()
+		self.moves.pop()
+
+	def attacked(self, sq, by_white):
+
+		x, y = sq % 8, sq // 8
+
+		pawn, knight, bishop, rook, queen, king = "PNBRQK" if by_white else "pnbrqk"
+
+		dy = -1 if by_white else 1
+		if self.piece_at(x - 1, y + dy) == pawn or self.piece_at(x + 1, y + dy) == pawn:
+			return True
+
+		for dx, dy in KNIGHT_STEPS:
+			if self.piece_at(x + dx, y + dy) == knight:
+				return True
+
+		for dx, dy in KING_STEPS:
+			if self.piece_at(x + dx, y + dy) == king:
+				return True
+
+		for dirs, sliders in [(ROOK_DIRS, [rook, queen]), (BISHOP_DIRS, [bishop, queen])]:
+			for dx, dy in dirs:
+				tx, ty = x + dx, y + dy
+				while 1:
+					target = self.piece_at(tx, ty)
+					if target is None:
+						break
+					if target:
+						if target in sliders:
+							return True
+						break
+					tx += dx
+					ty += dy
+
+		return False
+
+	def king_square(self, white):
+
+		return self.squares.index("K" if white else "k")
+
+	def in_check(self):
+
+		white = self.active == "w"
+		return self.attacked(self.king_square(white), not white)
+
+	def pseudolegal_moves(self):
+
+		white = self.active == "w"
+		ret = []
+
+		for sq, piece in enumerate(self.squares):
+
+			if not piece or piece.isupper() != white:
+				continue
+
+			x, y = sq % 8, sq // 8
+			kind = piece.upper()
+			targets = []
+
+			if kind == "P":
+
+				forward = 1 if white else -1
+
+				if self.piece_at(x, y + forward) == "":
+					targets.append((x, y + forward))
+					if y == (1 if white else 6) and self.piece_at(x, y + forward * 2) == "":
+						targets.append((x, y + forward * 2))
+
+				for dx in [-1, 1]:
+					target = self.piece_at(x + dx, y + forward)
+					if target is None:
+						continue
+					if (target and target.isupper() != white) or (target == "" and (y + forward) * 8 + x + dx == self.enpassant):
+						targets.append((x + dx, y + forward))
+
+				for tx, ty in targets:
+					if ty == 0 or ty == 7:
+						for promotion in "qrbn":
+							ret.append(square_name(sq) + square_name(ty * 8 + tx) + promotion)
+					else:
+						ret.append(square_name(sq) + square_name(ty * 8 + tx))
+
+				continue
+
+			if kind in ["N", "K"]:
+				for dx, dy in (KNIGHT_STEPS if kind == "N" else KING_STEPS):
+					target = self.piece_at(x + dx, y + dy)
+					if target == "" or (target and target.isupper() != white):
+						targets.append((x + dx, y + dy))
+			else:
+				dirs = {"R": ROOK_DIRS, "B": BISHOP_DIRS, "Q": ROOK_DIRS + BISHOP_DIRS}[kind]
+				for dx, dy in dirs:
+					tx, ty = x + dx, y + dy
+					while 1:
+						target = self.piece_at(tx, ty)
+						if target is None:
+							break
+						if target:
+							if target.isupper() != white:
+								targets.append((tx, ty))
+							break
+						targets.append((tx, ty))
+						tx += dx
+						ty += dy
+
+			for tx, ty in targets:
+				ret.append(square_name(sq) + square_name(ty * 8 + tx))
+
+		ret += self.castling_moves()
+		return ret
+
+	def castling_moves(self):
+
+		white = self.active == "w"
+		rank = 0 if white else 7
+		ret = []
+
+		if ("K" if white else "k") not in self.squares:
+			return ret
+
+		king_sq = self.king_square(white)
+		if king_sq // 8 != rank:
+			return ret
+
+		for rook_sq in self.castling:
+
+			if rook_sq // 8 != rank or self.squares[rook_sq] != ("R" if white else "r"):
+				continue
+
+			kingside = rook_sq % 8 > king_sq % 8
+			king_dest = rank * 8 + (6 if kingside else 2)
+			rook_dest = rank * 8 + (5 if kingside else 3)
+
+			lo = min(king_sq, king_dest, rook_sq, rook_dest)
+			hi = max(king_sq, king_dest, rook_sq, rook_dest)
+
+			if any(self.squares[sq] for sq in range(lo, hi + 1) if sq != king_sq and sq != rook_sq):
+				continue
+
+			step = 1 if king_dest >= king_sq else -1
+			if any(self.attacked(sq, not white) for sq in range(king_sq, king_dest + step, step)):
+				continue
+
+			if self.chess960:
+				ret.append(square_name(king_sq) + square_name(rook_sq))
+			else:
+				ret.append(square_name(king_sq) + square_name(king_dest))
+
+		return ret
+
+	def legal_moves(self):
+
+		white = self.active == "w"
+		ret = []
+
+		for mv in self.pseudolegal_moves():
+			b = self.copy()
+			b.move(mv)
+			if not b.attacked(b.king_square(white), not white):
+				ret.append(mv)
+
+		return ret
+
+	def is_legal(self, mv):
+
+		if not isinstance(mv, str) or len(mv) < 4:
+			return False
+
+		try:
+			src = square_index(mv[0:2])
+			dst = square_index(mv[2:4])
+		except ValueError:
+			return False
+
+		# Accept either castling notation by translating to the one we generate...
+
+		rook_sq = self.castling_rook(src, dst)
+		if rook_sq is not None:
+			if self.chess960:
+				mv = mv[0:2] + square_name(rook_sq)
+			else:
+				mv = mv[0:2] + square_name((src // 8) * 8 + (6 if rook_sq > src else 2))
+
+		return mv in self.legal_moves()
+
+	def hash(self):
+
+		h = 0
+
+		for sq, piece in enumerate(self.squares):
+			if piece:
+				h ^= ZOBRIST_PIECES[piece][sq]
+
+		for sq in self.castling:
+			h ^= ZOBRIST_CASTLING[sq]
+
+		if self.enpassant is not None:
+			h ^= ZOBRIST_ENPASSANT[self.enpassant % 8]
+
+		if self.active == "b":
+			h ^= ZOBRIST_BLACK
+
+		return h
+
 # ---------------------------------------------------------------------------------------------------------
 
-main()
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,203 @@
+import lszf
+
+def perft(board, depth):
+	if depth == 0:
+		return 1
+	n = 0
+	for mv in board.legal_moves():
+		board.move(mv)
+		n += perft(board, depth - 1)
+		board.undo()
+	return n
+
+def test_perft_standard():
+	assert [perft(lszf.Board(), d) for d in [1, 2, 3]] == [20, 400, 8902]
+
+def test_perft_kiwipete():
+	board = lszf.Board("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+	assert [perft(board, d) for d in [1, 2]] == [48, 2039]
+
+def test_perft_chess960():
+	board = lszf.Board("bqnb1rkr/pp3ppp/3ppn2/2p5/5P2/P2P4/NPP1P1PP/BQ1BNRKR w HFhf - 2 9", chess960 = True)
+	assert [perft(board, d) for d in [1, 2, 3]] == [21, 528, 12189]
+
+def test_hash_survives_undo():
+	board = lszf.Board()
+	before = board.hash()
+	for mv in ["e2e4", "e7e5", "g1f3"]:
+		board.move(mv)
+	for n in range(3):
+		board.undo()
+	assert board.hash() == before
+
+def test_diff_moves():
+	assert lszf.diff_moves("", "") == (0, [])
+	assert lszf.diff_moves("", "e2e4 e7e5") == (0, ["e2e4", "e7e5"])
+	assert lszf.diff_moves("e2e4", "e2e4 e7e5 g1f3") == (0, ["e7e5", "g1f3"])
+	assert lszf.diff_moves("e2e4 e7e5", "e2e4") == (1, [])
+	assert lszf.diff_moves("e2e4 e7e5", "e2e4 c7c5") == (1, ["c7c5"])
+
+def test_archive_round_trip():
+
+	game = lszf.Game("abcd1234")
+	game.gameFull = {
+		"white": {"name": "me"}, "black": {"aiLevel": 3}, "variant": {"key": "standard"},
+		"initialFen": "startpos", "createdAt": 1700000000000, "clock": {"initial": 180000, "increment": 2000},
+	}
+	game.colour = "white"
+	game.board = lszf.Board()
+	game.status = "mate"
+	game.winner = "black"
+
+	moves = ["f2f3", "e7e5", "g2g4", "d8h4"]
+	for mv in moves:
+		game.board.move(mv)
+	game.clocks = [179000, 178500, None, 170000]
+
+	lz_result = dict(lszf.new_result(), move = "f2f3", score = -20)
+	sf_result = dict(lszf.new_result(), move = "g2g3", score = 35)
+	game.decisions = [(0, {"move": "f2f3", "source": "lc0", "lz": lz_result, "sf": sf_result}), (2, {"move": "g2g4", "source": "forced", "lz": None, "sf": None})]
+
+	ret = lszf.decode_game(lszf.encode_game(game))
+
+	assert ret["id"] == "abcd1234"
+	assert ret["white"] == "me" and ret["black"] == "AI level 3"
+	assert ret["status"] == "mate" and ret["winner"] == "black"
+	assert ret["date"] == 1700000000 and ret["initial"] == 180 and ret["increment"] == 2
+	assert ret["moves"] == moves
+	assert ret["clocks"] == [179000, 178500, 179000, 170000]
+	assert ret["decisions"][0] == {"ply": 0, "source": "lc0", "lz_score": -20, "sf_score": 35, "lz_move": "f2f3", "sf_move": "g2g3"}
+	assert ret["decisions"][1]["source"] == "forced" and ret["decisions"][1]["lz_move"] is None
+
+class FakeEngine():
+	def __init__(self, shortname, weight = 1):
+		self.shortname = shortname
+		self.spec = {"weight": weight}
+
+def result(mv, score):
+	return dict(lszf.new_result(), move = mv, score = score)
+
+def aggregate(monkeypatch, policy, lz_result, *checker_results):
+	primary = FakeEngine("LZ")
+	checkers = [FakeEngine("C{}".format(n), weight = 2 if n == 0 else 1) for n in range(len(checker_results))]
+	monkeypatch.setattr(lszf, "config", {"aggregation": policy, "veto_cp": 75, "takeover_cp": 500})
+	monkeypatch.setattr(lszf, "engines", [primary] + checkers)
+	monkeypatch.setattr(lszf, "lz", primary)
+	monkeypatch.setattr(lszf, "sf", checkers[0])
+	decision = lszf.aggregate(lszf.Board(), [(primary, lz_result)] + list(zip(checkers, checker_results)))
+	return decision["move"], decision["source"]
+
+def test_aggregate_agreed(monkeypatch):
+	for policy in ["veto", "vote", "takeover"]:
+		assert aggregate(monkeypatch, policy, result("e2e4", 20), result("e2e4", 30), result("e2e4", 10)) == ("e2e4", "agreed")
+
+def test_aggregate_veto(monkeypatch):
+	assert aggregate(monkeypatch, "veto", result("e2e4", 20), result("d2d4", 50), result("g1f3", 10)) == ("e2e4", "lc0")
+	assert aggregate(monkeypatch, "veto", result("e2e4", 20), result("d2d4", 50), result("g1f3", 100)) == ("g1f3", "sf")
+	assert aggregate(monkeypatch, "veto", result("e2e4", 20), result("d2d4", 200), result("g1f3", 100)) == ("d2d4", "sf")
+
+def test_aggregate_vote(monkeypatch):
+	assert aggregate(monkeypatch, "vote", result("e2e4", 20), result("d2d4", 10), result("g1f3", 10)) == ("d2d4", "vote")
+	assert aggregate(monkeypatch, "vote", result("e2e4", 20), result("d2d4", 10), result("e2e4", 10)) == ("e2e4", "lc0")
+
+def test_aggregate_takeover(monkeypatch):
+	assert aggregate(monkeypatch, "takeover", result("e2e4", 20), result("d2d4", 400), result("g1f3", 10)) == ("e2e4", "lc0")
+	assert aggregate(monkeypatch, "takeover", result("e2e4", 20), result("d2d4", 600), result("g1f3", 10)) == ("d2d4", "sf")
+
+def test_aggregate_skips_illegal(monkeypatch):
+	assert aggregate(monkeypatch, "veto", result("e1g1", 20), result("d2d4", 10)) == ("d2d4", "lc0")
+	assert aggregate(monkeypatch, "veto", result("e1g1", 20), result("e1g1", 10)) == (None, "agreed")
+
+def partition(monkeypatch, mode, specs, cpus = 8, nodes = 1, share = 0.25):
+	monkeypatch.setattr(lszf, "config", {"cpu_partition": mode, "leela_cpu_share": share})
+	monkeypatch.setattr(lszf, "available_cpus", lambda: list(range(cpus)))
+	monkeypatch.setattr(lszf, "numa_nodes", lambda cpus: [cpus[n::nodes] for n in range(nodes)])
+	monkeypatch.setattr(lszf, "physical_cores", lambda cpus: [[cpu] for cpu in cpus])
+	return lszf.partition_cpus(specs)
+
+SPECS = [{"name": "LZ", "role": "primary", "cpus": [0, 1]}, {"name": "SF", "cpus": [2, 3]}]
+
+def test_partition_none_and_manual(monkeypatch):
+	assert partition(monkeypatch, "none", SPECS) == [None, None]
+	assert partition(monkeypatch, "manual", SPECS) == [[0, 1], [2, 3]]
+
+def test_partition_auto_cores(monkeypatch):
+	assert partition(monkeypatch, "auto", SPECS) == [[0, 1], [2, 3, 4, 5, 6, 7]]
+	three = [{"name": "A"}, {"name": "B", "role": "primary"}, {"name": "C"}]
+	assert partition(monkeypatch, "auto", three, share = 0.5) == [[4, 5], [0, 1, 2, 3], [6, 7]]
+
+def test_partition_auto_numa(monkeypatch):
+	assert partition(monkeypatch, "auto", SPECS, nodes = 2) == [[0, 2, 4, 6], [1, 3, 5, 7]]
+
+def test_partition_too_few_cores(monkeypatch):
+	three = [{"name": "A"}, {"name": "B"}, {"name": "C"}]
+	assert partition(monkeypatch, "auto", three, cpus = 2) == [None, None, None]
+
+CONSENSUS_CONFIG = {"resign_cp": 1000, "draw_cp": 15, "draw_moves": 3, "draw_min_ply": 4}
+
+def verdict(lz_score, sf_score):
+	return {"lz": result("e2e4", lz_score), "sf": result("e2e4", sf_score)}
+
+def test_update_consensus(monkeypatch):
+	monkeypatch.setattr(lszf, "config", CONSENSUS_CONFIG)
+	game = lszf.Game("g")
+	for decision in [verdict(-1200, -1500), verdict(-1100, -1000)]:
+		lszf.update_consensus(game, decision)
+	assert game.losing_moves == 2
+	lszf.update_consensus(game, {"lz": None, "sf": None})				# Book moves leave the counts alone
+	assert game.losing_moves == 2
+	lszf.update_consensus(game, verdict(-1200, -900))
+	assert game.losing_moves == 0
+	for decision in [verdict(10, -5), verdict(0, 15)]:
+		lszf.update_consensus(game, decision)
+	assert game.drawn_moves == 2
+	lszf.update_consensus(game, verdict(0, 16))
+	assert game.drawn_moves == 0
+
+def test_wants_draw(monkeypatch):
+	monkeypatch.setattr(lszf, "config", CONSENSUS_CONFIG)
+	game = lszf.Game("g")
+	game.colour = "white"
+	game.board = lszf.Board()
+	game.drawn_moves = 3
+	assert not lszf.wants_draw(game, {})							# Too early
+	for mv in ["g1f3", "g8f6", "f3g1", "f6g8"]:
+		game.board.move(mv)
+	assert lszf.wants_draw(game, {})
+	game.drawn_moves = 1
+	assert not lszf.wants_draw(game, {})
+	assert lszf.wants_draw(game, {"bdraw": True})					# Their offer needs only one verdict
+	assert not lszf.wants_draw(game, {"wdraw": True})
+	monkeypatch.setitem(CONSENSUS_CONFIG, "draw_moves", 0)
+	assert not lszf.wants_draw(game, {"bdraw": True})
+
+def test_rate_limited(monkeypatch):
+	now = [1000.0]
+	monkeypatch.setattr(lszf.time, "monotonic", lambda: now[0])
+	monkeypatch.setattr(lszf, "config", {"rate_limit_challenges": 2, "rate_limit_secs": 300})
+	monkeypatch.setattr(lszf, "challenge_history", dict())
+	assert not lszf.rate_limited("spammer")
+	assert not lszf.rate_limited("spammer")
+	assert lszf.rate_limited("spammer")
+	assert not lszf.rate_limited("someone")
+	now[0] += 301
+	assert not lszf.rate_limited("someone")
+	assert "spammer" not in lszf.challenge_history					# Idle challengers are forgotten
+
+def test_hold_challenge(monkeypatch):
+	monkeypatch.setattr(lszf, "config", {"max_waiting_challenges": 2})
+	monkeypatch.setattr(lszf, "waiting_challenges", [])
+	assert lszf.hold_challenge({"id": "a"})
+	assert lszf.hold_challenge({"id": "b"})
+	assert not lszf.hold_challenge({"id": "c"})
+	lszf.forget_waiting_challenge("a")
+	assert [challenge["id"] for received, challenge in lszf.waiting_challenges] == ["b"]
+
+def test_percentile():
+	values = list(range(1, 101))
+	assert lszf.percentile([], 50) == 0
+	assert lszf.percentile([7], 99) == 7
+	assert lszf.percentile(values, 50) == 50
+	assert lszf.percentile(values, 95) == 95
+	assert lszf.percentile(values, 100) == 100
+	assert lszf.percentile([1, 2, 3], 0) == 1